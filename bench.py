@@ -0,0 +1,412 @@
+# Copyright 2017 Jonathan Anderson
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import base64
+import collections
+import config
+import datetime
+import db
+import itertools
+import json
+import random
+import threading
+import time
+import urllib
+import urllib2
+
+
+def bounds(sizes = (100, 1000, 10000, 100000), repeat = 20, log = None):
+    """
+    Time POI.bounds() (without its cache) as the POI table grows.
+
+    This fills the POI table with random points, so it should only be run
+    against a scratch database (see `nerfherd bench`).
+
+    Returns: [ ( rows, median seconds ) ]
+    """
+    db.db.create_tables([ db.POI ], safe = True)
+    db.POI.delete().execute()
+
+    results = []
+    rows = 0
+
+    for size in sizes:
+        _insert(db.POI, (
+            {
+                'title': 'Benchmark POI %d' % i,
+                'latitude': random.uniform(52.1, 52.3),
+                'longitude': random.uniform(0.0, 0.2),
+                'icon': '/static/img/poi.png',
+            }
+            for i in range(rows, size)
+        ))
+
+        rows = max(rows, size)
+
+        times = []
+        for i in range(repeat):
+            db.POI.changed()
+
+            start = time.time()
+            db.POI.bounds()
+            times.append(time.time() - start)
+
+        median = sorted(times)[len(times) // 2]
+        results.append((rows, median))
+
+        if log:
+            log('POI.bounds() with %7d rows: %8.3f ms\n' % (rows, median * 1000))
+
+    return results
+
+
+def seed(people = 1000, products = 10, purchases = 3, payments = 1):
+    """
+    Fill a scratch database with attendees (the first of whom is an
+    administrator), products, purchases and payments.
+
+    purchases:  the number of (non-registration) purchases per attendee
+    payments:   the number of payments per attendee
+    """
+    db.init()
+    db.Product.update(cost = 6500).where(db.Product.name == 'Registration') \
+              .execute()
+
+    _insert(db.Product, (
+        {
+            'name': 'Benchmark product %d' % i,
+            'description': 'Benchmark product %d' % i,
+            'cost': random.randint(1, 100) * 100,
+        }
+        for i in range(products)
+    ))
+
+    _insert(db.Person, (
+        {
+            'name': 'Attendee %d' % i,
+            'username': 'attendee%d' % i,
+            'email': 'attendee%d@example.com' % i,
+            'address': '%d Benchmark Street' % i,
+            'administrator': i == 0,
+        }
+        for i in range(people)
+    ))
+
+    ids = [ id for (id,) in db.Person.select(db.Person.id).tuples() ]
+    items = [ id for (id,) in db.Product.select(db.Product.id).tuples() ]
+    registration = db.Product.registration_id()
+    today = datetime.date.today()
+
+    _insert(db.Purchase, (
+        {
+            'buyer': buyer,
+            'item': registration if i == 0 else random.choice(items),
+            'quantity': 1,
+            'date': today,
+        }
+        for buyer in ids
+        for i in range(purchases + 1)
+    ))
+
+    _insert(db.Payment, (
+        {
+            'payer': payer,
+            'date': today,
+            'value': random.randint(1, 100) * 100,
+        }
+        for payer in ids
+        for i in range(payments)
+    ))
+
+    db.Ledger.rebuild()
+
+
+def scenarios(app):
+    """
+    The requests to benchmark, as ( name, request, expected status ):
+    each request function takes a request number and returns
+    ( method, path, data, headers ).
+    """
+    people = list(db.Person.select().order_by(db.Person.id).limit(1000))
+    admin = [ p for p in people if p.administrator ][0]
+    items = [ p.id for p in db.Product.select() ]
+    shirt = db.Product.get(db.Product.name.startswith('Shirt (')).id
+    db.db.close()
+
+    org = {
+        'Authorization': 'Basic ' + base64.b64encode(
+            '%s:%s' % (admin.username, admin.auth())),
+    }
+
+    registration = '/register'
+    if not config.REGISTRATION_IS_OPEN:
+        registration += '?preregistration=' + \
+            app.config['PREREGISTRATION_CODE']
+
+    # Each benchmark run registers new people with unique email addresses.
+    run = int(time.time())
+
+    def register(i):
+        return ('POST', registration, {
+            'name': 'New attendee %d' % i,
+            'username': 'new%d-%d' % (run, i),
+            'email': 'new%d-%d@example.com' % (run, i),
+            'address': 'Benchmark Street',
+            'host': '-1',
+            'shirt_style': str(shirt),
+            'dietary_needs': '',
+        }, {})
+
+    def attendee(i):
+        p = people[i % len(people)]
+        return ('GET', '/attendee/%d?auth=%s' % (p.id, p.auth()), None, {})
+
+    def buy(i):
+        p = people[i % len(people)]
+        return ('GET', '/buy?item=%d&buyer=%d&auth=%s' % (
+            items[i % len(items)], p.id, p.auth()), None, {})
+
+    def page(path, headers = {}):
+        return lambda i: ('GET', path, None, headers)
+
+    return [
+        ('register', register, 302),
+        ('attendee', attendee, 200),
+        ('buy', buy, 302),
+        ('map', page('/map/'), 200),
+        ('org', page('/org/', org), 200),
+        ('org-attendees', page('/org/attendees/', org), 200),
+        ('org-purchases', page('/org/purchases/', org), 200),
+        ('org-payments', page('/org/payments/', org), 200),
+    ]
+
+
+class TestClient(object):
+    """ Sends requests through Flask's test client. """
+
+    def __init__(self, app):
+        self.app = app
+
+    def session(self):
+        client = self.app.test_client()
+
+        def send(method, path, data, headers):
+            return client.open(path, method = method, data = data,
+                               headers = headers).status_code
+
+        return send
+
+    def close(self):
+        pass
+
+
+class Server(object):
+    """ Sends HTTP requests to the app running in a local WSGI server. """
+
+    def __init__(self, app):
+        import werkzeug.serving
+
+        class QuietHandler(werkzeug.serving.WSGIRequestHandler):
+            def log_request(self, *args): pass
+
+        self.server = werkzeug.serving.make_server('127.0.0.1', 0, app,
+                                                   threaded = True,
+                                                   request_handler = QuietHandler)
+        self.root = 'http://127.0.0.1:%d' % self.server.server_port
+
+        thread = threading.Thread(target = self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def session(self):
+        opener = urllib2.build_opener(_NoRedirects)
+
+        def send(method, path, data, headers):
+            body = urllib.urlencode(data) if data is not None else None
+            request = urllib2.Request(self.root + path, body, headers)
+
+            try:
+                response = opener.open(request)
+                response.read()
+                return response.getcode()
+
+            except urllib2.HTTPError, e:
+                return e.code
+
+        return send
+
+    def close(self):
+        self.server.shutdown()
+
+class _NoRedirects(urllib2.HTTPRedirectHandler):
+    def redirect_request(self, *args):
+        return None
+
+
+def measure(request, expected, driver, count = 200, concurrency = 4):
+    """
+    Send `count` requests from `concurrency` threads and measure them,
+    counting responses without the expected status as errors.
+
+    Returns: { 'requests', 'errors', 'throughput' (requests/s), 'p50', 'p90',
+               'p99' (latency in ms), 'queries' (per request) }
+    """
+    numbers = itertools.count()
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def work():
+        send = driver.session()
+        while True:
+            i = next(numbers)
+            if i >= count:
+                return
+
+            (method, path, data, headers) = request(i)
+
+            start = time.time()
+            status = send(method, path, data, headers)
+            latency = time.time() - start
+
+            with lock:
+                latencies.append(latency)
+                if status != expected:
+                    errors.append(status)
+
+    queries = _QueryCounter()
+    threads = [ threading.Thread(target = work) for i in range(concurrency) ]
+
+    start = time.time()
+    with queries:
+        for t in threads: t.start()
+        for t in threads: t.join()
+
+    elapsed = time.time() - start
+    latencies.sort()
+
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))] \
+            * 1000
+
+    return {
+        'requests': count,
+        'errors': len(errors),
+        'throughput': count / elapsed,
+        'p50': percentile(0.5),
+        'p90': percentile(0.9),
+        'p99': percentile(0.99),
+        'queries': float(queries.count) / count,
+    }
+
+
+def suite(app, driver, count = 200, concurrency = 4, log = None):
+    """
+    Measure every scenario in turn.
+
+    Returns: { scenario: measurements (see measure()) }
+    """
+    results = collections.OrderedDict()
+
+    if log:
+        log('%-14s %8s %6s %9s %9s %9s %8s\n' % (
+            'scenario', 'req/s', 'errors', 'p50 ms', 'p90 ms', 'p99 ms',
+            'queries'))
+
+    for (name, request, expected) in scenarios(app):
+        r = measure(request, expected, driver, count, concurrency)
+        results[name] = r
+
+        if log:
+            log('%-14s %8.1f %6d %9.2f %9.2f %9.2f %8.1f\n' % (
+                name, r['throughput'], r['errors'], r['p50'], r['p90'],
+                r['p99'], r['queries']))
+
+    return results
+
+
+def compare(results, baseline, tolerance = 0.2):
+    """
+    Compare results against a saved baseline.
+
+    Returns: [ message ] describing each regression: throughput that has
+             dropped by more than `tolerance`, more queries per request or
+             new errors
+    """
+    regressions = []
+
+    for (name, r) in results.items():
+        old = baseline.get(name)
+        if old is None:
+            continue
+
+        if r['throughput'] < old['throughput'] * (1 - tolerance):
+            regressions.append('%s: %.1f req/s (was %.1f)' % (
+                name, r['throughput'], old['throughput']))
+
+        if r['queries'] > old['queries'] + 0.5:
+            regressions.append('%s: %.1f queries per request (was %.1f)' % (
+                name, r['queries'], old['queries']))
+
+        if r['errors'] > old['errors']:
+            regressions.append('%s: %d errors (was %d)' % (
+                name, r['errors'], old['errors']))
+
+    return regressions
+
+def load(filename):
+    with open(filename) as f:
+        return json.load(f)
+
+def save(results, filename):
+    with open(filename, 'w') as f:
+        json.dump(results, f, indent = 2, sort_keys = True)
+
+
+class _QueryCounter(object):
+    """ Counts the queries sent to the database (from any thread). """
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, sql, params, seconds):
+        with self._lock:
+            self.count += 1
+
+    def __enter__(self):
+        db.query_hooks.append(self)
+        return self
+
+    def __exit__(self, *args):
+        db.query_hooks.remove(self)
+
+
+def _insert(model, rows, chunk_size = 100):
+    with db.db.atomic():
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if not chunk:
+                break
+
+            model.insert_many(chunk).execute()
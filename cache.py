@@ -0,0 +1,145 @@
+# Copyright 2017 Jonathan Anderson
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import collections
+import hashlib
+import json
+import os
+import threading
+import time
+import warnings
+
+
+# Rendered public pages (e.g., the map) are cached so that a crowd of
+# anonymous visitors can be served without touching the database.
+# Pages are kept in an in-process LRU cache by default; if CACHE_URL names a
+# Redis server, pages are shared by (and invalidated for) every process.
+size = int(os.environ.get('CACHE_SIZE', 100))
+
+# How long (in seconds) a page may be served before being rendered again.
+# Invalidating the in-process cache only affects the process that made the
+# change, so this also limits how stale other processes' pages can get.
+ttl = int(os.environ.get('CACHE_TTL', 60))
+
+url = os.environ.get('CACHE_URL')
+
+
+# A rendered page along with the validators used for conditional requests:
+# its ETag and the time that it was rendered (seconds since the epoch).
+Page = collections.namedtuple('Page',
+        [ 'body', 'content_type', 'etag', 'modified' ])
+
+def page(body, content_type):
+    return Page(body, content_type, hashlib.sha1(body).hexdigest(),
+                int(time.time()))
+
+
+class LocalCache(object):
+    """ A least-recently-used cache of pages within this process. """
+
+    def __init__(self, size = size, ttl = ttl):
+        self.size = size
+        self.ttl = ttl
+
+        self._pages = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._pages.pop(key, None)
+            if entry is None:
+                return None
+
+            (page, expires) = entry
+            if expires < time.time():
+                return None
+
+            self._pages[key] = entry
+            return page
+
+    def put(self, key, page):
+        with self._lock:
+            self._pages.pop(key, None)
+            if len(self._pages) >= self.size:
+                self._pages.popitem(last = False)
+
+            self._pages[key] = (page, time.time() + self.ttl)
+
+    def clear(self):
+        with self._lock:
+            self._pages.clear()
+
+
+class RedisCache(object):
+    """
+    Pages shared by every process via Redis.
+
+    Rather than deleting pages, invalidation bumps a generation number that
+    is part of every page's key, leaving old pages to expire on their own.
+    """
+
+    prefix = 'nerf-herder:'
+
+    def __init__(self, url, ttl = ttl):
+        import redis
+
+        self.redis = redis.StrictRedis.from_url(url)
+        self.errors = redis.RedisError
+        self.ttl = ttl
+
+    def get(self, key):
+        try:
+            data = self.redis.get(self._key(key))
+
+        except self.errors, e:
+            warnings.warn('page cache unavailable: %s' % e)
+            return None
+
+        return Page(*json.loads(data)) if data else None
+
+    def put(self, key, page):
+        try: self.redis.setex(self._key(key), self.ttl, json.dumps(page))
+        except self.errors, e:
+            warnings.warn('page cache unavailable: %s' % e)
+
+    def clear(self):
+        try: self.redis.incr(self.prefix + 'generation')
+        except self.errors, e:
+            warnings.warn('unable to invalidate page cache: %s' % e)
+
+    def _key(self, key):
+        generation = self.redis.get(self.prefix + 'generation') or 0
+        return '%spage:%s:%s' % (self.prefix, generation, key)
+
+
+pages = LocalCache()
+
+if url:
+    try: pages = RedisCache(url)
+    except ImportError:
+        warnings.warn('CACHE_URL set but redis not installed; '
+                      'caching pages in-process')
+
+def invalidate():
+    """ Forget every cached page, e.g., after a POI has been changed. """
+    pages.clear()
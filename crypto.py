@@ -22,10 +22,12 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import base64
+import collections
 import config
 import hashlib
 import hmac as hm
 import os
+import threading
 
 secret = os.environ.get("SECRET_KEY")
 if secret is None:
@@ -42,12 +44,52 @@ if secret is None:
 else:
     secret = hashlib.sha512(secret).digest()
 
+# MACs are requested for the same few messages (e.g., attendee IDs) over and
+# over again, so remember the most recently-used ones (0 disables the cache).
+cache_size = int(os.environ.get('HMAC_CACHE_SIZE', 10000))
+_cache = collections.OrderedDict()
+_cache_key = secret
+_cache_lock = threading.Lock()
+
 def hmac(text):
     assert type(text) == str
     assert len(text) > 0
 
+    global _cache_key
+
+    with _cache_lock:
+        if _cache_key != secret:
+            _cache.clear()
+            _cache_key = secret
+
+        # Move a cached MAC to the end of the (least-recently-used first)
+        # ordering:
+        mac = _cache.pop(text, None)
+        if mac is not None:
+            _cache[text] = mac
+            return mac
+
     h = hm.new(secret, text, hashlib.sha512)
-    return base64.b32encode(h.digest()).lower()[:20]
+    mac = base64.b32encode(h.digest()).lower()[:20]
+
+    if cache_size <= 0:
+        return mac
+
+    with _cache_lock:
+        while len(_cache) >= cache_size:
+            _cache.popitem(last = False)
+
+        _cache[text] = mac
+
+    return mac
 
 def verify(text, mac):
-    return (mac == hmac(text))
+    """ Check a MAC for some text without leaking timing information. """
+    if not mac:
+        return False
+
+    try: return hm.compare_digest(_bytes(hmac(text)), _bytes(mac))
+    except UnicodeError: return False
+
+def _bytes(s):
+    return s if isinstance(s, bytes) else s.encode('ascii')
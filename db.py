@@ -21,24 +21,244 @@
 # OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import base64
 import config
 import crypto
+import datetime
+import functools
+import itertools
+import json
+import operator
 import os
 import peewee
 from peewee import *
+import random
+import sys
+import threading
+import time
+from playhouse import pool
+from playhouse.shortcuts import case
 
+# Python 2 imports _strptime lazily on the first call to strptime(), which can
+# fail when several threads parse dates at once (https://bugs.python.org/issue7980).
+import _strptime
+
+
+pool_size = int(os.environ.get('DATABASE_POOL_SIZE', 8))
+pool_timeout = int(os.environ.get('DATABASE_POOL_TIMEOUT', 10))
+stale_timeout = int(os.environ.get('DATABASE_STALE_TIMEOUT', 300))
+health_check = int(os.environ.get('DATABASE_HEALTH_CHECK', 30))
+
+# Functions to call after every query (e.g., to collect metrics), as
+# hook(sql, params, seconds).
+query_hooks = []
+
+
+class Pool(object):
+    """
+    Keeps statistics on a pool of database connections and checks that
+    connections that have sat idle for a while still work before reusing them.
+    Every query is also reported to the query_hooks.
+
+    Creating a pool doesn't open any connections, so a process can create
+    one and then fork (as a uWSGI master does when it loads the app before
+    starting its workers); each child should then call after_fork().
+    """
+
+    def __init__(self, database, health_check = health_check, **kwargs):
+        super(Pool, self).__init__(database, **kwargs)
+
+        self.health_check = health_check
+        self._inherited = []
+        self._reset_stats()
+
+    def _reset_stats(self):
+        self._returned = {}
+        self._stats_lock = threading.Lock()
+        self._checkouts = 0
+        self._failed = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def after_fork(self):
+        """
+        Forget any connections inherited from the parent process so that this
+        process opens its own.
+
+        The inherited connections are kept (but never used) rather than being
+        closed or garbage-collected, which would close them for the parent too.
+        """
+        self._inherited += [ conn for (ts, conn) in self._connections ]
+        if self._local.conn:
+            self._inherited.append(self._local.conn)
+
+        self._connections = []
+        self._in_use = {}
+        self._closed = set()
+        self._local = type(self._local)()
+        self._conn_lock = threading.Lock()
+        self._reset_stats()
+
+    def connect(self):
+        start = time.time()
+        try: super(Pool, self).connect()
+        except pool.MaxConnectionsExceeded:
+            with self._stats_lock:
+                self._failed += 1
+            raise
+
+        wait = time.time() - start
+        with self._stats_lock:
+            self._checkouts += 1
+            self._wait_total += wait
+            self._wait_max = max(self._wait_max, wait)
+
+    def execute_sql(self, sql, params = None, require_commit = True):
+        start = time.time()
+        try:
+            return super(Pool, self).execute_sql(sql, params, require_commit)
+
+        finally:
+            elapsed = time.time() - start
+            for hook in tuple(query_hooks):
+                hook(sql, params, elapsed)
+
+    def stats(self):
+        """ Describe this process' pool, e.g., to size uWSGI workers. """
+        with self._stats_lock:
+            checkouts = self._checkouts
+
+            return {
+                'max_connections': self.max_connections,
+                'in_use': len(self._in_use),
+                'idle': len(self._connections),
+                'checkouts': checkouts,
+                'timeouts': self._failed,
+                'wait_total': self._wait_total,
+                'wait_mean': self._wait_total / checkouts if checkouts else 0.0,
+                'wait_max': self._wait_max,
+            }
+
+    def _close(self, conn, close_conn = False):
+        key = self.conn_key(conn)
+        if close_conn:
+            self._returned.pop(key, None)
+        elif key in self._in_use:
+            self._returned[key] = time.time()
+
+        super(Pool, self)._close(conn, close_conn)
+
+    def _is_closed(self, key, conn):
+        idle = time.time() - self._returned.pop(key, 0)
+        if super(Pool, self)._is_closed(key, conn):
+            return True
+
+        if idle < self.health_check:
+            return False
+
+        try:
+            conn.cursor().execute('SELECT 1')
+            conn.rollback()
+            return False
+
+        except Exception:
+            sys.stderr.write('WARNING: discarding broken database connection\n')
+            try: conn.close()
+            except Exception: pass
+            return True
+
+
+class PooledMySQLDatabase(Pool, pool.PooledMySQLDatabase): pass
+class PooledPostgresqlDatabase(Pool, pool.PooledPostgresqlDatabase): pass
+class PooledSqliteDatabase(Pool, pool.PooledSqliteDatabase): pass
+
+
+def open_database(url):
+    (scheme, name) = url.split('://')
+    (Database, options) = {
+        'mysql': (PooledMySQLDatabase, {}),
+        'postgres': (PooledPostgresqlDatabase, {}),
+
+        # Pooled connections may be returned by one thread and reused by
+        # another.
+        'sqlite': (PooledSqliteDatabase, { 'check_same_thread': False }),
+    }[scheme]
+
+    return Database(name, max_connections = pool_size, timeout = pool_timeout,
+                    stale_timeout = stale_timeout, **options)
+
+
+db = open_database(config.DATABASE_URL)
+replicas = [
+    open_database(url.strip())
+    for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',')
+    if url.strip()
+]
+
+# How long (in seconds) a client that has just written something should keep
+# reading from the primary database rather than from a lagging replica.
+replica_lag = int(os.environ.get('DATABASE_REPLICA_LAG', 10))
+
+
+class Router(threading.local):
+    """
+    Chooses the database that SELECT queries are sent to.
+
+    Everything goes to the primary database unless the current thread has
+    asked to read from a replica (e.g., while serving a read-only view).
+    Writes always go to the primary.
+    """
+
+    replica = None
+
+    def database(self):
+        return self.replica or db
+
+    def read_from_replica(self):
+        if not replicas:
+            return
+
+        replica = random.choice(replicas)
+        try:
+            if replica.is_closed():
+                replica.connect()
+
+        except peewee.DatabaseError, e:
+            sys.stderr.write(
+                'WARNING: replica unavailable, using primary: %s\n' % e)
+            return
+
+        self.replica = replica
+
+    def release(self):
+        (replica, self.replica) = (self.replica, None)
+        if replica and not replica.is_closed():
+            replica.close()
+
+
+router = Router()
+
+
+def after_fork():
+    """
+    Prepare a newly-forked worker process to use the database (see wsgi.py).
+    """
+    router.replica = None
+
+    for database in [ db ] + replicas:
+        database.after_fork()
 
-(scheme, url) = config.DATABASE_URL.split('://')
-db = {
-    'mysql': MySQLDatabase,
-    'postgres': PostgresqlDatabase,
-    'sqlite': SqliteDatabase,
-}[scheme](url)
 
 class BaseModel(Model):
     class Meta:
         database = db
 
+    @classmethod
+    def select(cls, *selection):
+        query = super(BaseModel, cls).select(*selection)
+        query.database = router.database()
+        return query
+
 class Money(object):
     name = os.environ.get('CURRENCY')
     symbol = os.environ.get('CURRENCY_SYMBOL')
@@ -89,14 +309,114 @@ class Money(object):
 
 
 
+class Page(object):
+    """
+    One page of a query's results.
+
+    Pages are found by seeking past the sort key of the previous (or next)
+    page's last (or first) row rather than by skipping OFFSET rows, so every
+    page costs the same to fetch no matter how far into the results it is.
+    Rows are ordered by the sort key and then the primary key; nullable
+    sort keys are also ordered by whether or not they are NULL.
+    """
+
+    def __init__(self, query, key, descending = False, limit = 50,
+                 after = None, before = None):
+        model = query.model_class
+        pk = model._meta.primary_key
+
+        self.terms = []
+        for field in ([ key, pk ] if key is not pk else [ pk ]):
+            if field.null:
+                self.terms.append((field.is_null(), field, True))
+            self.terms.append((field, field, False))
+
+        self.count = query.count()
+        self.limit = limit
+
+        forward = (before is None)
+        ascending = (forward != descending)
+
+        if after is not None or before is not None:
+            cursor = self.decode(after if forward else before)
+            query = query.where(self.seek(cursor, ascending))
+
+        query = (
+            query.order_by(*[
+                    expr.asc() if ascending else expr.desc()
+                    for (expr, _, _) in self.terms
+                 ])
+                 .limit(limit + 1)
+        )
+
+        items = list(query)
+        more = len(items) > limit
+        items = items[:limit]
+
+        if forward:
+            self.items = items
+            self.previous = self.cursor(items[0]) if after and items else None
+            self.next = self.cursor(items[-1]) if more else None
+
+        else:
+            self.items = items[::-1]
+            self.previous = self.cursor(self.items[0]) if more else None
+            self.next = self.cursor(self.items[-1]) if self.items else None
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def cursor(self, row):
+        """ An opaque token identifying a row's position in the results. """
+        values = [
+            row._data.get(field.name) is None if null_flag
+                else row._data.get(field.name)
+            for (_, field, null_flag) in self.terms
+        ]
+
+        return base64.urlsafe_b64encode(json.dumps(values, default = str))
+
+    def decode(self, cursor):
+        try: values = json.loads(base64.urlsafe_b64decode(str(cursor)))
+        except (TypeError, ValueError):
+            raise ValueError('invalid page cursor: %s' % cursor)
+
+        if type(values) != list or len(values) != len(self.terms):
+            raise ValueError('invalid page cursor: %s' % cursor)
+
+        return [
+            bool(v) if null_flag else
+                None if v is None else field.python_value(v)
+            for ((_, field, null_flag), v) in zip(self.terms, values)
+        ]
+
+    def seek(self, values, ascending):
+        """ An expression matching rows that sort after a cursor's row. """
+        clauses = []
+
+        for (i, (expr, _, _)) in enumerate(self.terms):
+            clause = expr > values[i] if ascending else expr < values[i]
+
+            for (j, (prior, _, _)) in enumerate(self.terms[:i]):
+                clause = (prior == values[j]) & clause
+
+            clauses.append(clause)
+
+        return functools.reduce(operator.or_, clauses)
+
+
+
 class POI(BaseModel):
     """
     A point of interest in the vicinity of the DevSummit,
     e.g., working rooms, restaurants and transit.
     """
 
-    latitude = FloatField()
-    longitude = FloatField()
+    latitude = FloatField(index = True)
+    longitude = FloatField(index = True)
     title = TextField(unique = True)
     description = TextField(null = True)
     icon = TextField()
@@ -106,28 +426,83 @@ class POI(BaseModel):
     class Meta:
         order_by = [ 'title' ]
 
+    # Bounding boxes computed by bounds(), keyed by query.  They are forgotten
+    # whenever a POI is saved or deleted by this process, or after
+    # bounds_ttl seconds (in case another process has changed something).
+    bounds_ttl = 60
+    _bounds = {}
+    _bounds_lock = threading.Lock()
+
     @classmethod
-    def bounds(cls):
+    def bounds(cls, *criteria):
         """
-        A bounding box containing all POI that match given criteria.
+        A bounding box containing all POI that match given criteria
+        (e.g., `POI.title.startswith('Room ')`), computed in the database.
 
         Returns: ( min_lon, min_lat, max_lon, max_lat )
         """
+        # Look up each extreme in its own subquery so that the database can
+        # use the index on latitude or longitude rather than a full scan.
+        extremes = []
+        for (aggregate, field) in (
+                (fn.MIN, cls.longitude), (fn.MIN, cls.latitude),
+                (fn.MAX, cls.longitude), (fn.MAX, cls.latitude)):
+
+            query = cls.select(aggregate(field)).order_by()
+            if criteria:
+                query = query.where(*criteria)
+
+            extremes.append(query.sql())
 
-        minimum = (180, 90)
-        maximum = (-180, -90)
+        sql = 'SELECT ' + ', '.join([ '(%s)' % sql for (sql, _) in extremes ])
+        params = [ p for (_, params) in extremes for p in params ]
+        key = (sql, tuple(params))
 
-        for p in POI.select():
-            lon = p.longitude
-            lat = p.latitude
+        with cls._bounds_lock:
+            (bounds, expires) = cls._bounds.get(key, (None, 0))
 
-            minimum = (min(lon, minimum[0]), min(lat, minimum[1]))
-            maximum = (max(lon, maximum[0]), max(lat, maximum[1]))
+        if expires > time.time():
+            return bounds
+
+        cursor = query.database.execute_sql(sql, params, require_commit = False)
+        (min_lon, min_lat, max_lon, max_lat) = cursor.fetchone()
+
+        minimum = (
+            min_lon if min_lon is not None else 180,
+            min_lat if min_lat is not None else 90,
+        )
+        maximum = (
+            max_lon if max_lon is not None else -180,
+            max_lat if max_lat is not None else -90,
+        )
 
         minimum = tuple([ i - (2.0/3600) for i in minimum ])
         maximum = tuple([ i + (2.0/3600) for i in maximum ])
+        bounds = minimum + maximum
+
+        with cls._bounds_lock:
+            if len(cls._bounds) >= 100:
+                cls._bounds.clear()
+
+            cls._bounds[key] = (bounds, time.time() + cls.bounds_ttl)
+
+        return bounds
+
+    @classmethod
+    def changed(cls):
+        """ Forget cached bounds after POIs have been changed. """
+        with cls._bounds_lock:
+            cls._bounds.clear()
+
+    def save(self, *args, **kwargs):
+        result = super(POI, self).save(*args, **kwargs)
+        POI.changed()
+        return result
 
-        return minimum + maximum
+    def delete_instance(self, *args, **kwargs):
+        result = super(POI, self).delete_instance(*args, **kwargs)
+        POI.changed()
+        return result
 
     def __str__(self):
         return "'%s' @ (%f,%f): '%s'" % (
@@ -146,7 +521,7 @@ class Person(BaseModel):
     """
 
     name = TextField()
-    username = TextField(null = True)
+    username = TextField(null = True, index = True)
     email = TextField(null = True, unique = True)
     address = TextField()
     administrator = BooleanField(default = False)
@@ -161,27 +536,194 @@ class Person(BaseModel):
 
     @classmethod
     def balances(cls):
-        """ How much each attendee has paid and still owes us. """
-        attendees = cls.select()
+        """
+        How much each attendee has paid and still owes us.
+
+        Balances are read from the Ledger rather than re-summed from each
+        attendee's payments and purchases, so the number of queries doesn't
+        depend on the number of attendees.
+        """
+        balances = Ledger.balances()
+
+        return { a: Money(balances.get(a.id, 0)) for a in cls.select() }
 
-        balances = {}
-        for a in attendees:
-            paid = sum([ p.amount() for p in a.payments ])
-            owing = sum([ p.total() for p in a.purchases ]) - paid
 
-            balances[a] = owing
+    @classmethod
+    def statements(cls, chunk_size = 500):
+        """
+        Every Person along with their host's name (as `host_name`), their
+        balance and their purchases.
 
-        return balances
+        People are loaded `chunk_size` at a time (along with their hosts'
+        names and their ledger entries) and their purchases are loaded for
+        the whole chunk at once, so the number of queries doesn't depend on
+        the number of people and only one chunk is held in memory at a time.
 
+        Yields: ( Person, Money, [ Purchase ] )
+        """
+        Host = Person.alias()
+
+        query = (
+            cls.select(
+                    cls,
+                    Host.name.alias('host_name'),
+                    Ledger.purchases.alias('ledger_purchases'),
+                    Ledger.payments.alias('ledger_payments'),
+               )
+               .join(Host, JOIN.LEFT_OUTER, on = (cls.host == Host.id))
+               .switch(cls)
+               .join(Ledger, JOIN.LEFT_OUTER, on = (Ledger.person == cls.id))
+               .order_by(cls.id)
+               .limit(chunk_size)
+               .naive()
+        )
+
+        last = None
+        while True:
+            people = list(query.where(cls.id > last) if last else query)
+            if not people:
+                return
+
+            purchases = (
+                Purchase.select(Purchase, Product)
+                        .join(Product)
+                        .where(Purchase.buyer << [ p.id for p in people ])
+                        .order_by(Purchase.buyer, Purchase.date)
+            )
+            bought = dict(
+                (buyer, list(items)) for (buyer, items)
+                in itertools.groupby(purchases, key = lambda p: p.buyer_id)
+            )
+
+            for person in people:
+                person._account = Ledger(
+                    person = person.id,
+                    purchases = person.ledger_purchases or 0,
+                    payments = person.ledger_payments or 0,
+                )
+
+                yield (
+                    person,
+                    person.total_purchases() - person.paid(),
+                    bought.get(person.id, []),
+                )
+
+            last = people[-1].id
+
+    @classmethod
+    def with_accounts(cls):
+        """
+        Select people along with their hosts and Ledger entries, so that
+        `host`, `paid()` and `total_purchases()` don't need any more queries.
+        """
+        Host = Person.alias()
+
+        return (
+            cls.select(cls, Host, Ledger)
+               .join(Host, JOIN.LEFT_OUTER,
+                     on = (cls.host == Host.id).alias('host'))
+               .switch(cls)
+               .join(Ledger, JOIN.LEFT_OUTER,
+                     on = (Ledger.person == cls.id).alias('_account'))
+        )
+
+    def history(self):
+        """
+        This Person's purchases (along with the Products they bought) and
+        payments, in two queries however many of each there are.
+
+        Returns: ( [ Purchase ], [ Payment ] )
+        """
+        purchases = (
+            Purchase.select(Purchase, Product)
+                    .join(Product)
+                    .where(Purchase.buyer == self)
+        )
+
+        return (list(purchases), list(self.payments))
+
+    @classmethod
+    def register(cls, shirt = None, **fields):
+        """
+        Register a new attendee in a single transaction: create the Person,
+        buy their registration (and, if given the ID of a shirt product,
+        a complimentary shirt) and make them an administrator if they are
+        the first person to register.
+
+        Raises: Product.DoesNotExist if there is no Registration product,
+                IntegrityError if the attendee has already registered
+        """
+        registration = Product.registration_id()
+
+        # Registrations are serialized so that only one of several people
+        # registering at the same time can become the first registrant:
+        # SQLite can take its write lock up front, while other databases
+        # lock the Registration product (only while the table is empty).
+        sqlite = isinstance(db, SqliteDatabase)
+
+        with db.atomic('IMMEDIATE') if sqlite else db.atomic():
+            first = not cls.select(cls.id).order_by().exists()
+
+            if first and db.for_update:
+                list(Product.select(Product.id)
+                            .where(Product.id == registration)
+                            .order_by()
+                            .for_update())
+
+                first = not cls.select(cls.id).order_by().exists()
+
+            person = cls.create(administrator = first, **fields)
+
+            now = datetime.datetime.now()
+            purchases = [
+                { 'buyer': person.id, 'item': registration,
+                  'quantity': 1, 'date': now },
+            ]
+
+            if shirt is not None:
+                purchases.append({ 'buyer': person.id, 'item': shirt,
+                                   'quantity': 1, 'date': now,
+                                   'complimentary': True })
+
+            Purchase.insert_many(purchases).execute()
+
+            # Bulk inserts bypass Purchase.save(), so account for the
+            # registration fee (at its current price) here:
+            Ledger.insert(
+                person = person.id,
+                purchases = (
+                    Product.select(Product.cost)
+                           .where(Product.id == registration)
+                           .order_by()
+                ),
+            ).execute()
+
+        return person
+
+    def account(self):
+        """ The Ledger entry that tracks this Person's purchases and payments. """
+        if not hasattr(self, '_account'):
+            try: self._account = Ledger.get(person = self)
+            except Ledger.DoesNotExist:
+                self._account = Ledger(person = self)
+
+        # with_accounts() leaves an empty Ledger if there was no entry to join:
+        elif self._account.purchases is None:
+            self._account = Ledger(person = self)
+
+        return self._account
 
     def auth(self):
         return crypto.hmac(str(self.id))
 
+    def check_auth(self, code):
+        return crypto.verify(str(self.id), code)
+
     def paid(self):
-        return sum([ p.amount() for p in self.payments ])
+        return Money(self.account().payments)
 
     def total_purchases(self):
-        return sum([ p.total() for p in self.purchases ])
+        return Money(self.account().purchases)
 
     def __str__(self):
         return self.name
@@ -216,13 +758,71 @@ class Product(BaseModel):
     class Meta:
         order_by = [ 'name' ]
 
+    # The ID of the Registration product (see registration_id()).
+    _registration_id = None
+
+    def save(self, *args, **kwargs):
+        with db.atomic():
+            if self._get_pk_value() is not None:
+                old = Product.get(id = self.id)
+                Ledger.reprice(self, self.cost - old.cost)
+
+            return super(Product, self).save(*args, **kwargs)
+
+    @classmethod
+    def registration_id(cls):
+        """
+        The ID of the Registration product that every attendee buys.
+        Its price may change but the product itself doesn't, so this is only
+        looked up once.
+        """
+        if cls._registration_id is None:
+            cls._registration_id = (
+                cls.select(cls.id)
+                   .where(cls.name == 'Registration')
+                   .order_by()
+                   .get()
+                   .id
+            )
+
+        return cls._registration_id
+
+    @classmethod
+    def with_statistics(cls):
+        """
+        All Products, annotated with the number of purchases (`orders`),
+        the quantity sold (`sold`) and the revenue from non-complimentary
+        purchases (`revenue`), computed with a single grouped query.
+        """
+        chargeable = case(None, (
+            (Purchase.complimentary == False, Purchase.quantity),
+        ), 0)
+
+        return (
+            cls.select(
+                    cls,
+                    fn.COUNT(Purchase.id).alias('orders'),
+                    fn.COALESCE(fn.SUM(Purchase.quantity), 0).alias('sold'),
+                    fn.COALESCE(fn.SUM(chargeable * cls.cost), 0)
+                      .alias('revenue'),
+               )
+               .join(Purchase, JOIN.LEFT_OUTER)
+               .group_by(cls)
+        )
+
     def price(self):
         return Money(self.cost)
 
     def quantity(self):
+        if hasattr(self, 'sold'):
+            return int(self.sold)
+
         return sum([ p.quantity for p in self.purchases ])
 
     def all_purchases(self):
+        if hasattr(self, 'revenue'):
+            return Money(int(self.revenue))
+
         return sum(p.total() for p in self.purchases)
 
     def __str__(self):
@@ -246,9 +846,57 @@ class Purchase(BaseModel):
     class Meta:
         order_by = [ 'date' ]
 
+    @classmethod
+    def totals_by_buyer(cls):
+        """
+        The total (non-complimentary) cost of all purchases made by each
+        Person, in a single query.
+
+        Returns: { person_id: micro }
+        """
+        query = (
+            cls.select(cls.buyer, fn.SUM(cls.quantity * Product.cost))
+               .join(Product)
+               .where(cls.complimentary == False)
+               .group_by(cls.buyer)
+               .order_by()
+               .tuples()
+        )
+
+        return { buyer: int(total) for (buyer, total) in query }
+
+    def save(self, *args, **kwargs):
+        with db.atomic():
+            if self._get_pk_value() is not None:
+                old = Purchase.get(id = self.id)
+                Ledger.adjust(old.buyer_id, purchases = -old.total().micro)
+
+            result = super(Purchase, self).save(*args, **kwargs)
+            Ledger.adjust(self.buyer_id, purchases = self.total().micro)
+
+        return result
+
+    def delete_instance(self, *args, **kwargs):
+        with db.atomic():
+            Ledger.adjust(self.buyer_id, purchases = -self.total().micro)
+            return super(Purchase, self).delete_instance(*args, **kwargs)
+
     def name(self):
         return str(self.item) + (' (gratis)' if self.complimentary else '')
 
+    @classmethod
+    def with_details(cls):
+        """
+        Select purchases along with their buyers and the Products they bought,
+        so that `buyer`, `item` and `total()` don't need any more queries.
+        """
+        return (
+            cls.select(cls, Person, Product)
+               .join(Person)
+               .switch(cls)
+               .join(Product)
+        )
+
     def total(self):
         return (
             Money(0) if self.complimentary
@@ -262,17 +910,264 @@ class Payment(BaseModel):
     """
 
     payer = ForeignKeyField(Person, related_name = 'payments')
-    date = DateField()
+    date = DateField(index = True)
     value = IntegerField()
     note = TextField(null = True)
 
     class Meta:
         order_by = [ 'date' ]
 
+    @classmethod
+    def totals_by_payer(cls):
+        """
+        The total value of all payments made by each Person, in a single query.
+
+        Returns: { person_id: micro }
+        """
+        query = (
+            cls.select(cls.payer, fn.SUM(cls.value))
+               .group_by(cls.payer)
+               .order_by()
+               .tuples()
+        )
+
+        return { payer: int(total) for (payer, total) in query }
+
+    @classmethod
+    def with_payers(cls):
+        """ Select payments along with the people who made them. """
+        return cls.select(cls, Person).join(Person)
+
+    def save(self, *args, **kwargs):
+        with db.atomic():
+            if self._get_pk_value() is not None:
+                old = Payment.get(id = self.id)
+                Ledger.adjust(old.payer_id, payments = -old.value)
+
+            result = super(Payment, self).save(*args, **kwargs)
+            Ledger.adjust(self.payer_id, payments = self.value)
+
+        return result
+
+    def delete_instance(self, *args, **kwargs):
+        with db.atomic():
+            Ledger.adjust(self.payer_id, payments = -self.value)
+            return super(Payment, self).delete_instance(*args, **kwargs)
+
     def amount(self): return Money(self.value)
     def __str__(self): return str(self.amount())
 
 
+class Ledger(BaseModel):
+    """
+    Running totals of a Person's purchases and payments.
+
+    These totals are adjusted whenever a Purchase, Payment or Product price
+    is saved or deleted, so balances can be read without re-summing every
+    purchase and payment.  They can be recomputed from scratch with rebuild().
+    """
+
+    person = ForeignKeyField(Person, primary_key = True,
+                             related_name = 'ledger', on_delete = 'CASCADE')
+    purchases = IntegerField(default = 0)
+    payments = IntegerField(default = 0)
+
+    @classmethod
+    def adjust(cls, person_id, purchases = 0, payments = 0):
+        """ Add to (or subtract from) a Person's running totals. """
+        if purchases == 0 and payments == 0:
+            return
+
+        update = (
+            cls.update(
+                    purchases = cls.purchases + purchases,
+                    payments = cls.payments + payments,
+               )
+               .where(cls.person == person_id)
+        )
+
+        if update.execute() > 0:
+            return
+
+        # This is the Person's first entry, unless a concurrent writer has
+        # just created it (in which case the primary key stops us creating
+        # another and we can update theirs instead).
+        try:
+            with db.atomic():
+                cls.create(person = person_id,
+                           purchases = purchases, payments = payments)
+
+        except IntegrityError:
+            update.execute()
+
+    @classmethod
+    def reprice(cls, product, delta):
+        """ Account for a change in the unit cost of a Product. """
+        if delta == 0:
+            return
+
+        quantities = (
+            Purchase.select(Purchase.buyer, fn.SUM(Purchase.quantity))
+                    .where(Purchase.item == product)
+                    .where(Purchase.complimentary == False)
+                    .group_by(Purchase.buyer)
+                    .order_by()
+                    .tuples()
+        )
+
+        for (buyer, quantity) in quantities:
+            cls.adjust(buyer, purchases = delta * int(quantity))
+
+    @classmethod
+    def balances(cls):
+        """
+        How much each Person still owes us.
+
+        Returns: { person_id: micro }
+        """
+        query = cls.select(cls.person, cls.purchases - cls.payments).tuples()
+        return { person: int(balance) for (person, balance) in query }
+
+    @classmethod
+    def computed(cls):
+        """
+        Totals computed from the raw purchase and payment records.
+
+        Returns: { person_id: (purchases, payments) }
+        """
+        purchases = Purchase.totals_by_buyer()
+        payments = Payment.totals_by_payer()
+
+        return {
+            person: (purchases.get(person, 0), payments.get(person, 0))
+            for person in set(purchases) | set(payments)
+        }
+
+    @classmethod
+    def rebuild(cls):
+        """ Recompute every Person's totals from purchases and payments. """
+        db.create_tables([ cls ], safe = True)
+
+        rows = [
+            { 'person': person, 'purchases': purchases, 'payments': payments }
+            for (person, (purchases, payments)) in cls.computed().items()
+        ]
+
+        with db.atomic():
+            cls.delete().execute()
+            for i in range(0, len(rows), 100):
+                cls.insert_many(rows[i:i + 100]).execute()
+
+        return len(rows)
+
+    @classmethod
+    def verify(cls):
+        """
+        Compare the stored totals against purchases and payments.
+
+        Returns: [ (person_id, stored, computed) ] for every Person whose
+                 stored (purchases, payments) totals have drifted
+        """
+        stored = {
+            person: (purchases, payments)
+            for (person, purchases, payments)
+            in cls.select(cls.person, cls.purchases, cls.payments).tuples()
+        }
+        computed = cls.computed()
+
+        return sorted(
+            (person, stored.get(person, (0, 0)), computed.get(person, (0, 0)))
+            for person in set(stored) | set(computed)
+            if stored.get(person, (0, 0)) != computed.get(person, (0, 0))
+        )
+
+
+class QueuedMail(BaseModel):
+    """
+    A message waiting to be (or that has been) sent by the mailer.
+    """
+
+    recipients = TextField()
+    subject = TextField()
+    body = TextField()
+    status = TextField(default = 'pending', index = True)
+    attempts = IntegerField(default = 0)
+    queued = DateTimeField(default = datetime.datetime.now)
+    next_attempt = DateTimeField(default = datetime.datetime.now, index = True)
+    sent = DateTimeField(null = True)
+    error = TextField(null = True)
+
+    class Meta:
+        order_by = [ '-queued' ]
+
+    # How long a mailer may spend sending a message before another mailer
+    # assumes that it has died and tries again.
+    lease = datetime.timedelta(minutes = 10)
+
+    @classmethod
+    def due(cls, now):
+        return (
+            cls.select()
+               .where(cls.status << [ 'pending', 'sending' ])
+               .where(cls.next_attempt <= now)
+               .order_by(cls.next_attempt)
+        )
+
+    @classmethod
+    def status_counts(cls):
+        query = (
+            cls.select(cls.status, fn.COUNT(cls.id))
+               .group_by(cls.status)
+               .order_by()
+               .tuples()
+        )
+
+        return dict(query)
+
+    @classmethod
+    def sent_since(cls, when):
+        return cls.select().where(cls.sent >= when).count()
+
+    def recipient_list(self):
+        return self.recipients.split(',')
+
+    def claim(self, now):
+        """
+        Take responsibility for sending this message, unless another mailer
+        has already done so.
+        """
+        claimed = (
+            QueuedMail.update(status = 'sending',
+                              next_attempt = now + self.lease)
+                      .where(QueuedMail.id == self.id)
+                      .where(QueuedMail.next_attempt == self.next_attempt)
+                      .execute()
+        )
+
+        return claimed == 1
+
+    def delivered(self, now):
+        self.status = 'sent'
+        self.attempts += 1
+        self.sent = now
+        self.error = None
+        self.save()
+
+    def failed(self, now, error, max_attempts):
+        """ Record a failure and back off exponentially before retrying. """
+        self.attempts += 1
+        self.error = error
+
+        if self.attempts >= max_attempts:
+            self.status = 'failed'
+        else:
+            self.status = 'pending'
+            self.next_attempt = (
+                now + datetime.timedelta(minutes = 2 ** self.attempts))
+
+        self.save()
+
+
 class Todo(BaseModel):
     """
     Something that one of the organizers is supposed to do.
@@ -281,11 +1176,32 @@ class Todo(BaseModel):
     class Meta:
         order_by = [ 'deadline' ]
 
+        # The dashboard lists incomplete todos by deadline:
+        indexes = (
+            (('complete', 'deadline'), False),
+        )
+
     description = TextField()
     deadline = DateTimeField(null = True)
     assignee = ForeignKeyField(Person, null = True, related_name = 'todos')
     complete = BooleanField(default = False)
 
+    @classmethod
+    def with_assignees(cls):
+        """ Select todos along with the people (if any) assigned to them. """
+        return cls.select(cls, Person).join(Person, JOIN.LEFT_OUTER)
+
+
+class SchemaVersion(BaseModel):
+    """
+    A schema migration that has been applied to the database (see
+    migrations.py).
+    """
+
+    version = IntegerField(primary_key = True)
+    description = TextField()
+    applied = DateTimeField(default = datetime.datetime.now)
+
 
 ALL_TABLES = (
         POI,
@@ -293,7 +1209,10 @@ ALL_TABLES = (
         Product,
         Purchase,
         Payment,
+        Ledger,
+        QueuedMail,
         Todo,
+        SchemaVersion,
 )
 
 def init(drop_first = True):
@@ -23,8 +23,66 @@
 
 from flask_wtf import FlaskForm
 from wtforms.fields import *
-from wtforms.widgets import HiddenInput, TextArea
+from wtforms.widgets import HiddenInput, HTMLString, Select, TextArea
+from wtforms.widgets import html_params
 from wtforms.validators import Email, Optional, Required
+from flask_wtf.file import FileField, FileRequired
+
+
+class Choices(tuple):
+    """
+    An immutable list of (value, label) choices that can be shared by
+    many forms, with a constant-time lookup of each value's label.
+    """
+
+    def __new__(cls, choices):
+        self = tuple.__new__(cls, choices)
+        self.labels = dict(self)
+        return self
+
+
+def people_choices(people, blank = False):
+    return Choices(
+        ([ (-1, '') ] if blank else []) + [ (p.id, p.name) for p in people ])
+
+def host_choices(hosts):
+    return people_choices(hosts, blank = True)
+
+def share_choices(field, choices, source):
+    """
+    Use a precomputed set of choices for a select field, rendering it with
+    a SharedSelect whose options are copied from the `source` element.
+    """
+    field.choices = choices
+    field.widget = SharedSelect(source)
+
+
+class SharedSelect(Select):
+    """
+    A <select> that only renders its current value.
+
+    The rest of the options are copied from a shared element (identified by
+    the `source` ID) when the user starts interacting with the field, so a
+    table of many forms doesn't need to repeat a long list of options in
+    every row.
+    """
+
+    def __init__(self, source):
+        Select.__init__(self)
+        self.source = source
+
+    def __call__(self, field, **kwargs):
+        kwargs.setdefault('id', field.id)
+        kwargs['data-choices'] = self.source
+
+        label = field.choices.labels.get(field.data, '')
+
+        return HTMLString(''.join([
+            '<select %s>' % html_params(name = field.name, **kwargs),
+            self.render_option(field.data, label, True),
+            '</select>',
+        ]))
+
 
 class AttendeeForm(FlaskForm):
     name = TextField(validators = [ Required() ])
@@ -40,7 +98,7 @@ class AttendeeForm(FlaskForm):
     dietary_needs = TextField()
 
     def add_hosts(self, hosts):
-        self.host.choices = [ (-1, '') ] + [ (p.id, p.name) for p in hosts ]
+        self.host.choices = host_choices(hosts)
         return self
 
     def validate(self):
@@ -77,9 +135,13 @@ class AttendeeUpdate(AttendeeForm):
     id = IntegerField(widget = HiddenInput())
 
     @classmethod
-    def for_person(cls, person, hosts):
+    def for_person(cls, person, choices):
+        """
+        Create a form for updating a Person, sharing a precomputed set of
+        host choices (see host_choices) with other such forms.
+        """
         form = AttendeeUpdate(None, obj = person)
-        form.host.choices = [ (-1, '') ] + [ (p.id, p.name) for p in hosts ]
+        share_choices(form.host, choices, 'host-choices')
         form.host.data = person.host_id if person.host_id else -1
         return form
 
@@ -90,7 +152,9 @@ class MailForm(FlaskForm):
     subject = TextField(validators = [ Required() ],
         render_kw={"placeholder": "will be prefixed with [DevSummit Name]"})
     body = TextField(widget = TextArea(), validators = [ Required() ],
-        render_kw={"placeholder": "plain text only", "rows": "10"})
+        render_kw={"placeholder":
+            "plain text only; may refer to {{ name }}, {{ balance }}, "
+            "{{ link }} and {{ purchases }}", "rows": "10"})
     send = SubmitField()
 
 class POIForm(FlaskForm):
@@ -105,6 +169,10 @@ class POIForm(FlaskForm):
 class POIUpdateForm(POIForm):
     id = IntegerField(widget = HiddenInput())
 
+class POIImportForm(FlaskForm):
+    file = FileField(validators = [ FileRequired() ])
+    icon = TextField('Default icon', validators = [ Optional() ])
+
 
 class ProductForm(FlaskForm):
     name = TextField()
@@ -141,10 +209,14 @@ class PurchaseUpdateForm(PurchaseForm):
 
         else:
             form = PurchaseUpdateForm(None, obj = data)
-            form.buyer.data = data.buyer.id
-            form.item.data = data.item.id
+            form.buyer.data = data.buyer_id
+            form.item.data = data.item_id
+
+        if isinstance(people, Choices):
+            share_choices(form.buyer, people, 'people-choices')
+        else:
+            form.set_buyers(people)
 
-        form.set_buyers(people)
         form.set_products(products)
 
         return form
@@ -168,6 +240,13 @@ class PaymentForm(FlaskForm):
 class PaymentUpdateForm(PaymentForm):
     id = IntegerField(widget = HiddenInput())
 
+    @classmethod
+    def for_payment(cls, payment, choices):
+        form = PaymentUpdateForm(None, obj = payment)
+        share_choices(form.payer, choices, 'people-choices')
+        form.payer.data = payment.payer_id
+        return form
+
 
 class TodoForm(FlaskForm):
     description = TextField(validators = [ Required() ])
@@ -186,3 +265,10 @@ class TodoForm(FlaskForm):
 
 class TodoUpdateForm(TodoForm):
     id = IntegerField(widget = HiddenInput())
+
+    @classmethod
+    def for_todo(cls, todo, choices):
+        form = TodoUpdateForm(None, obj = todo)
+        share_choices(form.assignee, choices, 'people-choices')
+        form.assignee.data = todo.assignee_id if todo.assignee_id else -1
+        return form
@@ -0,0 +1,218 @@
+# Copyright 2017 Jonathan Anderson
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import db
+import math
+import os
+import threading
+import time
+
+
+# POIs are indexed in a grid of cells this many degrees on a side.
+cell_size = float(os.environ.get('POI_GRID_SIZE', 0.01))
+
+# The index only sees POI changes made by its own process, so it is rebuilt
+# from the database after this many seconds.
+max_age = int(os.environ.get('POI_INDEX_TTL', 60))
+
+# At zoom levels below this, nearby POIs are grouped into clusters about
+# cluster_pixels across (on 256-pixel map tiles).
+cluster_zoom = int(os.environ.get('POI_CLUSTER_ZOOM', 16))
+cluster_pixels = 64
+
+
+class Grid(object):
+    """ A spatial index of POIs, kept in a grid of fixed-size cells. """
+
+    def __init__(self, size = cell_size):
+        self.size = size
+        self._cells = {}
+        self._where = {}
+
+    def __len__(self):
+        return len(self._where)
+
+    def cell(self, longitude, latitude):
+        return (
+            int(math.floor(longitude / self.size)),
+            int(math.floor(latitude / self.size)),
+        )
+
+    def add(self, poi):
+        self.remove(poi.id)
+
+        key = self.cell(poi.longitude, poi.latitude)
+        self._cells.setdefault(key, {})[poi.id] = poi
+        self._where[poi.id] = key
+
+    def remove(self, id):
+        key = self._where.pop(id, None)
+        if key is None:
+            return
+
+        cell = self._cells[key]
+        del cell[id]
+        if not cell:
+            del self._cells[key]
+
+    def within(self, bbox):
+        """
+        All POIs within a bounding box.
+
+        bbox: ( min_lon, min_lat, max_lon, max_lat )
+        """
+        (min_lon, min_lat, max_lon, max_lat) = bbox
+        (x0, y0) = self.cell(min_lon, min_lat)
+        (x1, y1) = self.cell(max_lon, max_lat)
+
+        # Look up the cells covered by the box, unless there are fewer
+        # non-empty cells than that to look at.
+        if (x1 - x0 + 1) * (y1 - y0 + 1) <= len(self._cells):
+            cells = (
+                self._cells.get((x, y), {})
+                for x in range(x0, x1 + 1)
+                for y in range(y0, y1 + 1)
+            )
+
+        else:
+            cells = (
+                cell for ((x, y), cell) in self._cells.items()
+                if x0 <= x <= x1 and y0 <= y <= y1
+            )
+
+        return [
+            p for cell in cells for p in cell.values()
+            if min_lon <= p.longitude <= max_lon
+                and min_lat <= p.latitude <= max_lat
+        ]
+
+    def all(self):
+        return [ p for cell in self.cells() for p in cell ]
+
+    def cells(self):
+        return [ cell.values() for cell in self._cells.values() ]
+
+
+class Index(object):
+    """
+    A Grid of every POI, built from the database when first needed and kept
+    up to date with changes made by this process.
+    """
+
+    def __init__(self, max_age = max_age):
+        self.max_age = max_age
+        self._grid = None
+        self._built = 0
+        self._lock = threading.Lock()
+
+    def grid(self):
+        with self._lock:
+            if self._grid is None or time.time() - self._built > self.max_age:
+                grid = Grid()
+                for p in db.POI.select().order_by():
+                    grid.add(p)
+
+                (self._grid, self._built) = (grid, time.time())
+
+            return self._grid
+
+    def saved(self, poi):
+        with self._lock:
+            if self._grid is not None:
+                self._grid.add(poi)
+
+    def deleted(self, id):
+        with self._lock:
+            if self._grid is not None:
+                self._grid.remove(id)
+
+    def clear(self):
+        with self._lock:
+            self._grid = None
+
+    def features(self, bbox = None, zoom = None):
+        """
+        The POIs within a bounding box as a GeoJSON FeatureCollection,
+        clustered if the map is zoomed out far enough.
+        """
+        grid = self.grid()
+        with self._lock:
+            poi = grid.within(bbox) if bbox is not None else grid.all()
+
+        if zoom is not None and zoom < cluster_zoom:
+            features = cluster(poi, zoom)
+        else:
+            features = [ feature(p) for p in poi ]
+
+        return {
+            'type': 'FeatureCollection',
+            'features': features,
+        }
+
+
+def cluster(poi, zoom):
+    """ Group POIs that would be drawn close together at a zoom level. """
+    size = 360.0 / 2 ** zoom * cluster_pixels / 256
+    grid = Grid(size)
+    for p in poi:
+        grid.add(p)
+
+    features = []
+    for members in grid.cells():
+        if len(members) == 1:
+            features.append(feature(members[0]))
+            continue
+
+        features.append({
+            'type': 'Feature',
+            'geometry': point(
+                sum(p.longitude for p in members) / len(members),
+                sum(p.latitude for p in members) / len(members),
+            ),
+            'properties': {
+                'cluster': True,
+                'count': len(members),
+            },
+        })
+
+    return features
+
+def feature(poi):
+    return {
+        'type': 'Feature',
+        'id': poi.id,
+        'geometry': point(poi.longitude, poi.latitude),
+        'properties': {
+            'title': poi.title,
+            'description': poi.description,
+            'icon': poi.icon,
+            'width': poi.width,
+            'height': poi.height,
+        },
+    }
+
+def point(longitude, latitude):
+    return { 'type': 'Point', 'coordinates': [ longitude, latitude ] }
+
+
+index = Index()
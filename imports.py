@@ -0,0 +1,478 @@
+# Copyright 2017 Jonathan Anderson
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import collections
+import csv
+import datetime
+import db
+import itertools
+import json
+
+
+# The outcome of an import: how many records were created and updated,
+# along with ( where, message ) for each record that was rejected.
+Imported = collections.namedtuple('Imported', [ 'created', 'updated', 'errors' ])
+
+
+def records(stream, filename):
+    """
+    Read records from a CSV file (with a header row) or from JSON
+    (a list of objects or a GeoJSON FeatureCollection), depending on the
+    file's name.
+
+    Yields: ( where, { column: value } ), or ( where, ValueError ) for
+            JSON objects that can't be read as records
+
+    Raises: ValueError if the file can't be parsed or (for JSON) isn't a list
+            or FeatureCollection
+    """
+    if filename.lower().endswith('.csv'):
+        reader = csv.DictReader(stream)
+        try:
+            for record in reader:
+                record = {
+                    key: value.decode('utf-8') if value else value
+                    for (key, value) in record.items()
+                }
+
+                yield ('line %d' % reader.line_num, record)
+
+        except csv.Error, e:
+            raise ValueError('line %d: %s' % (reader.line_num + 1, e))
+
+        return
+
+    # JSON is a single document, so it has to be read all at once;
+    # its objects are then converted to records one at a time.
+    data = json.load(stream)
+    items = data.get('features', []) if isinstance(data, dict) else data
+    if not isinstance(items, list):
+        raise ValueError('expected a list of objects or a FeatureCollection')
+
+    for (i, item) in enumerate(items):
+        if not isinstance(item, dict):
+            yield ('record %d' % (i + 1), ValueError('not an object'))
+            continue
+
+        if item.get('type') != 'Feature':
+            yield ('record %d' % (i + 1), dict(item))
+            continue
+
+        yield ('feature %d' % (i + 1), _feature(item))
+
+
+def _feature(item):
+    """
+    Convert a GeoJSON Feature into a record, or a ValueError describing
+    what's wrong with it.
+    """
+    properties = item.get('properties')
+    if not isinstance(properties, dict):
+        return ValueError('no properties')
+
+    record = dict(properties)
+
+    geometry = item.get('geometry') or {}
+    if not isinstance(geometry, dict):
+        return ValueError('geometry is not an object')
+
+    if geometry.get('type') == 'Point':
+        coordinates = geometry.get('coordinates')
+        if not (isinstance(coordinates, list) and len(coordinates) >= 2 and
+                all(isinstance(x, (int, long, float)) and
+                    not isinstance(x, bool) for x in coordinates[:2])):
+            return ValueError('point has no valid coordinates')
+
+        (record['longitude'], record['latitude']) = coordinates[:2]
+
+    return record
+
+
+# Alternative names for POI columns, e.g., in OpenStreetMap extracts.
+poi_aliases = {
+    'title': ( 'title', 'name' ),
+    'latitude': ( 'latitude', 'lat' ),
+    'longitude': ( 'longitude', 'lon', 'lng' ),
+    'description': ( 'description', 'note' ),
+    'icon': ( 'icon', ),
+    'width': ( 'width', ),
+    'height': ( 'height', ),
+}
+
+def poi(record, icon = None):
+    """
+    Convert a record into the fields of a POI.
+    Optional fields are only included if the record has them.
+
+    Raises: ValueError if the record doesn't describe a valid POI
+    """
+    def get(name):
+        for alias in poi_aliases[name]:
+            value = record.get(alias)
+            if value not in (None, ''):
+                return value
+
+    title = get('title')
+    if not title:
+        raise ValueError('no title')
+
+    try:
+        latitude = float(get('latitude'))
+        longitude = float(get('longitude'))
+
+    except (TypeError, ValueError):
+        raise ValueError("'%s' has no valid latitude and longitude" % title)
+
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        raise ValueError("'%s' is not on Earth" % title)
+
+    fields = {
+        'title': unicode(title),
+        'latitude': latitude,
+        'longitude': longitude,
+    }
+
+    for name in ('description', 'icon'):
+        value = get(name) or (icon if name == 'icon' else None)
+        if value:
+            fields[name] = value
+
+    for name in ('width', 'height'):
+        value = get(name)
+        if value is not None:
+            try: fields[name] = int(value)
+            except ValueError:
+                raise ValueError("'%s' has invalid %s" % (title, name))
+
+    return fields
+
+
+def import_poi(records, icon = None, chunk_size = 500):
+    """
+    Create (or, if their titles are already taken, update) POIs in batches
+    within a single transaction.
+
+    icon:   the icon to use for records that don't name one
+
+    Returns: Imported
+    """
+    created = updated = 0
+    errors = []
+
+    valid = _valid(records, lambda r: poi(r, icon), errors)
+    # Rows inserted together must all have the same columns:
+    defaults = {
+        'description': None,
+        'width': db.POI.width.default,
+        'height': db.POI.height.default,
+    }
+
+    with db.db.atomic():
+        while True:
+            # A title may appear more than once in a file; the last one wins.
+            chunk = collections.OrderedDict(
+                (fields['title'], (where, fields))
+                for (where, fields) in itertools.islice(valid, chunk_size)
+            )
+
+            if not chunk:
+                break
+
+            existing = (
+                db.POI.select(db.POI.title)
+                      .where(db.POI.title << list(chunk.keys()))
+                      .order_by()
+                      .tuples()
+            )
+
+            rows = [ chunk.pop(title)[1] for (title,) in existing ]
+            for i in range(0, len(rows), update_size):
+                _update_poi(rows[i:i + update_size])
+
+            updated += len(rows)
+
+            new = []
+            for (where, fields) in chunk.values():
+                if 'icon' not in fields:
+                    errors.append((where, "'%s' has no icon" % fields['title']))
+                    continue
+
+                new.append(dict(defaults, **fields))
+
+            _insert(db.POI, new)
+            created += len(new)
+
+    db.POI.changed()
+
+    return Imported(created, updated, errors)
+
+
+# SQLite allows no more than this many parameters in a statement.
+max_parameters = 999
+
+# POIs to update per statement: each one takes up to 13 parameters.
+update_size = 50
+
+def _update_poi(rows):
+    """
+    Update several POIs (identified by their titles) in one statement,
+    choosing each column's new value with a CASE on the title.
+    Columns that a row doesn't mention keep their current values.
+    """
+    columns = set(name for fields in rows for name in fields) - { 'title' }
+
+    values = {}
+    for name in columns:
+        field = getattr(db.POI, name)
+        values[field] = db.case(db.POI.title, [
+            (fields['title'], fields[name]) for fields in rows if name in fields
+        ], field)
+
+    titles = [ fields['title'] for fields in rows ]
+    db.POI.update(values).where(db.POI.title << titles).execute()
+
+
+def attendee(record):
+    """
+    Convert a record into the fields of a Person, plus the username or email
+    address of their host (as 'host') and the name of their shirt size
+    (as 'shirt', e.g., 'M/L') if they have them.
+
+    Raises: ValueError if the record doesn't describe a valid attendee
+    """
+    def get(name):
+        value = record.get(name)
+        return value.strip() if isinstance(value, basestring) else value
+
+    name = get('name')
+    if not name:
+        raise ValueError('no name')
+
+    fields = {
+        'name': unicode(name),
+        'username': get('username') or None,
+        'email': get('email') or None,
+        'address': get('address') or '',
+        'dietary_needs': get('dietary_needs') or None,
+        'host': get('host') or None,
+        'shirt': get('shirt') or None,
+    }
+
+    if fields['email'] is None:
+        if fields['username'] is None:
+            raise ValueError("'%s' has no email address or username" % name)
+
+        fields['email'] = '%s@FreeBSD.org' % fields['username']
+
+    for date in ('arrival', 'departure'):
+        value = get(date)
+        if not value:
+            fields[date] = None
+            continue
+
+        try:
+            fields[date] = datetime.datetime.strptime(value, '%Y-%m-%d').date()
+
+        except (TypeError, ValueError):
+            raise ValueError("'%s' has invalid %s date '%s'" % (
+                name, date, value))
+
+    return fields
+
+
+def import_attendees(records, chunk_size = 500):
+    """
+    Register attendees in batches, each in its own transaction: create
+    each Person along with their Registration and (complimentary) shirt
+    purchases and their Ledger entry.
+
+    Attendees whose email addresses are already registered (or that appear
+    earlier in the same file) are reported as errors rather than imported.
+    Hosts are looked up by username or email address once everyone has been
+    created, so attendees may be listed before their hosts.
+
+    Returns: Imported
+    """
+    created = 0
+    errors = []
+
+    valid = _valid(records, attendee, errors)
+    registration = db.Product.get(name = 'Registration')
+    shirts = {
+        p.name: p for p in
+        db.Product.select().where(db.Product.name.startswith('Shirt ('))
+    }
+
+    seen = set()
+    hosts = []
+
+    while True:
+        chunk = []
+        for (where, fields) in itertools.islice(valid, chunk_size):
+            if fields['email'] in seen:
+                errors.append((where,
+                    "duplicate email address '%s'" % fields['email']))
+                continue
+
+            shirt = fields.pop('shirt')
+            if shirt and 'Shirt (%s)' % shirt not in shirts:
+                errors.append((where, "unknown shirt size '%s'" % shirt))
+                continue
+
+            seen.add(fields['email'])
+            chunk.append((where, fields, shirt))
+
+        if not chunk:
+            break
+
+        with db.db.atomic():
+            emails = [ fields['email'] for (_, fields, _) in chunk ]
+            existing = set(
+                email for (email,) in
+                db.Person.select(db.Person.email)
+                         .where(db.Person.email << emails)
+                         .order_by()
+                         .tuples()
+            )
+
+            people = []
+            for (where, fields, shirt) in chunk:
+                if fields['email'] in existing:
+                    errors.append((where, "'%s' is already registered" %
+                                   fields['email']))
+                    continue
+
+                host = fields.pop('host')
+                if host:
+                    hosts.append((where, fields['email'], host))
+
+                people.append((fields, shirt))
+
+            if not people:
+                continue
+
+            _insert(db.Person, [ fields for (fields, _) in people ])
+
+            emails = [ fields['email'] for (fields, _) in people ]
+            ids = dict(
+                db.Person.select(db.Person.email, db.Person.id)
+                         .where(db.Person.email << emails)
+                         .order_by()
+                         .tuples()
+            )
+
+            now = datetime.datetime.now()
+            purchases = []
+            for (fields, shirt) in people:
+                buyer = ids[fields['email']]
+                purchases.append({ 'buyer': buyer, 'item': registration.id,
+                                   'quantity': 1, 'date': now,
+                                   'complimentary': False })
+
+                if shirt:
+                    purchases.append({
+                        'buyer': buyer,
+                        'item': shirts['Shirt (%s)' % shirt].id,
+                        'quantity': 1,
+                        'date': now,
+                        'complimentary': True,
+                    })
+
+            _insert(db.Purchase, purchases)
+
+            # Purchases inserted in bulk bypass Purchase.save(), so account
+            # for the registration fees here:
+            _insert(db.Ledger, [
+                { 'person': id, 'purchases': registration.cost, 'payments': 0 }
+                for id in ids.values()
+            ])
+
+            created += len(people)
+
+    errors += _set_hosts(hosts, chunk_size)
+
+    return Imported(created, 0, errors)
+
+
+def _set_hosts(hosts, chunk_size):
+    """
+    Point imported attendees at their hosts.
+
+    hosts: [ ( where, guest email, host username or email ) ]
+
+    Returns: [ ( where, error ) ] for hosts that can't be found
+    """
+    errors = []
+
+    for i in range(0, len(hosts), chunk_size):
+        chunk = hosts[i:i + chunk_size]
+        names = list(set(host for (_, _, host) in chunk))
+
+        found = {}
+        for (id, username, email) in (
+                db.Person.select(db.Person.id, db.Person.username,
+                                 db.Person.email)
+                         .where((db.Person.username << names) |
+                                (db.Person.email << names))
+                         .order_by()
+                         .tuples()):
+            found[username] = found[email] = id
+
+        guests = collections.defaultdict(list)
+        for (where, guest, host) in chunk:
+            if host in found:
+                guests[found[host]].append(guest)
+            else:
+                errors.append((where, "unknown host '%s'" % host))
+
+        with db.db.atomic():
+            for (host, emails) in guests.items():
+                (db.Person.update(host = host)
+                          .where(db.Person.email << emails)
+                          .execute())
+
+    return errors
+
+
+def _insert(model, rows):
+    """
+    Insert rows (which must all have the same columns) in as few statements
+    as max_parameters allows.  Peewee also inserts the default values of any
+    fields that the rows leave out, so allow for every field of the model.
+    """
+    size = max(max_parameters // len(model._meta.fields), 1)
+    for i in range(0, len(rows), size):
+        model.insert_many(rows[i:i + size]).execute()
+
+
+def _valid(records, convert, errors):
+    """ Convert records, noting the ones that can't be converted. """
+    for (where, record) in records:
+        try:
+            if isinstance(record, ValueError):
+                raise record
+
+            yield (where, convert(record))
+
+        except ValueError, e:
+            errors.append((where, e.args[0]))
@@ -21,22 +21,269 @@
 # OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import collections
 import config
+import datetime
+import db
+import itertools
 from email.header import Header
 from email.mime.text import MIMEText
+import jinja2.sandbox
+import metrics
 import os
 import smtplib
+import socket
+import threading
+import time
 import warnings
 
 replyto = os.environ.get("MAIL_REPLYTO")
 
+smtp_server = os.environ.get("MAIL_SMTP", "localhost")
+pool_size = int(os.environ.get("MAIL_POOL_SIZE", 2))
+batch_size = int(os.environ.get("MAIL_BATCH_SIZE", 50))
+max_attempts = int(os.environ.get("MAIL_MAX_ATTEMPTS", 8))
+
+
+# How long it took to send one message to a batch of recipients.
+Batch = collections.namedtuple('Batch', [ 'recipients', 'seconds' ])
+
+
+class Transport(object):
+    """
+    Sends messages over a pool of reusable SMTP connections,
+    reconnecting if a pooled connection has gone stale.
+    """
+
+    def __init__(self, server = smtp_server, size = pool_size):
+        self.server = server
+        self.size = size
+
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def sendmail(self, sender, recipients, message):
+        """ Send a message, retrying once on a fresh connection. """
+        for attempt in range(2):
+            connection = self._checkout()
+
+            try:
+                connection.sendmail(sender, recipients, message)
+
+            except (smtplib.SMTPServerDisconnected, socket.error):
+                self._discard(connection)
+                if attempt > 0:
+                    raise
+
+            except:
+                self._discard(connection)
+                raise
+
+            else:
+                self._checkin(connection)
+                return
+
+    def close(self):
+        with self._lock:
+            (idle, self._idle) = (self._idle, [])
+
+        for connection in idle:
+            self._discard(connection)
+
+    def _checkout(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+
+        return smtplib.SMTP(self.server)
+
+    def _checkin(self, connection):
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append(connection)
+                return
+
+        self._discard(connection)
+
+    def _discard(self, connection):
+        try: connection.quit()
+        except (smtplib.SMTPException, socket.error):
+            connection.close()
+
+
+transport = Transport()
+
+
 def send(recipients, subject, body):
+    """
+    Send a message to some recipients, Bcc'ing large recipient lists in
+    batches of at most MAIL_BATCH_SIZE.
+
+    Returns: [ Batch ]
+    """
     assert type(recipients) == tuple or type(recipients) == list
 
     if replyto is None:
         warnings.warn('MAIL_REPLYTO not set, not mailing %s' % recipients)
-        return
+        return []
+
+    if len(recipients) == 1:
+        batches = [ recipients ]
+    else:
+        batches = [
+            recipients[i:i + batch_size]
+            for i in range(0, len(recipients), batch_size)
+        ]
+
+    results = []
+    for batch in batches:
+        start = time.time()
+        transport.sendmail(replyto, batch, message(batch, subject, body))
+        results.append(Batch(len(batch), time.time() - start))
+        metrics.mail_seconds.observe(results[-1].seconds)
+
+    return results
+
+
+def enqueue(recipients, subject, body):
+    """
+    Queue a message for the mailer to send, one queue entry per batch
+    of recipients.
+    """
+    assert type(recipients) == tuple or type(recipients) == list
+
+    with db.db.atomic():
+        for i in range(0, len(recipients), batch_size):
+            db.QueuedMail.create(
+                recipients = ','.join(recipients[i:i + batch_size]),
+                subject = subject,
+                body = body,
+            )
+
+
+def enqueue_many(messages, chunk_size = 300):
+    """
+    Queue a (possibly very long) stream of (recipient, subject, body)
+    messages without holding more than `chunk_size` of them in memory.
+
+    The messages are queued in a single transaction, so that if one of them
+    can't be produced (e.g., a template fails to render for one attendee),
+    none of them are sent.  Each chunk is inserted with one statement, which
+    SQLite limits to 999 parameters (three per message).
+
+    Returns: the number of messages queued
+    """
+    count = 0
+
+    with db.db.atomic():
+        while True:
+            rows = [
+                { 'recipients': recipient, 'subject': subject, 'body': body }
+                for (recipient, subject, body)
+                in itertools.islice(messages, chunk_size)
+            ]
+
+            if not rows:
+                return count
+
+            db.QueuedMail.insert_many(rows).execute()
+            count += len(rows)
+
+
+def personalise(statements, subject, body, link):
+    """
+    Render a message body (a Jinja template) for each attendee.
+
+    The template can refer to `attendee`, `name`, `balance`, `purchases`
+    (one line per purchase, with its quantity and total) and `link`
+    (the attendee's own page).
+
+    statements: ( Person, Money, [ Purchase ] ) tuples (see Person.statements)
+    link:       function that returns the URL of a Person's attendee page
+
+    Yields: ( recipient, subject, body )
+    """
+    template = _templates.from_string(body)
+
+    for (person, balance, purchases) in statements:
+        if not person.email:
+            continue
+
+        yield (person.email, subject, template.render(
+            attendee = person,
+            name = person.name,
+            balance = balance,
+            purchases = '\n'.join([
+                '%d x %s: %s' % (p.quantity, p.name(), p.total())
+                for p in purchases
+            ]),
+            link = link(person),
+        ))
+
+_templates = jinja2.sandbox.SandboxedEnvironment()
+
+
+def deliver(limit = 100):
+    """
+    Send queued messages that are due to be sent.
+
+    Returns: (messages sent, messages that failed)
+    """
+    if replyto is None:
+        warnings.warn('MAIL_REPLYTO not set, not delivering queued mail')
+        return (0, 0)
+
+    now = datetime.datetime.now()
+    (sent, failed) = (0, 0)
+
+    for m in db.QueuedMail.due(now).limit(limit):
+        if not m.claim(now):
+            continue
+
+        try:
+            send(m.recipient_list(), m.subject, m.body)
+
+        except Exception, e:
+            m.failed(datetime.datetime.now(), str(e), max_attempts)
+            failed += 1
+
+        else:
+            m.delivered(datetime.datetime.now())
+            sent += 1
+
+    return (sent, failed)
+
+
+def run_mailer(interval, log = None):
+    """ Deliver queued mail forever, polling every `interval` seconds. """
+    while True:
+        start = time.time()
+
+        try: (sent, failed) = deliver()
+        except db.peewee.DatabaseError, e:
+            if log: log('Unable to deliver queued mail: %s\n' % e)
+            (sent, failed) = (0, 0)
+
+        elapsed = time.time() - start
+
+        if log and (sent or failed):
+            log('Sent %d messages (%d failed) in %.1f s: %.1f messages/s\n' % (
+                sent, failed, elapsed, (sent + failed) / max(elapsed, 1e-3)))
+
+        if not (sent or failed):
+            time.sleep(interval)
+
+
+def start_mailer(interval):
+    """ Deliver queued mail from a background thread. """
+    thread = threading.Thread(target = run_mailer, args = (interval,))
+    thread.daemon = True
+    thread.start()
+
+    return thread
+
 
+def message(recipients, subject, body):
     msg = MIMEText(body.encode('utf-8'), 'plain', 'utf-8')
     msg['Subject'] = Header(subject, 'utf-8')
     msg['From'] = os.environ.get("MAIL_FROM")
@@ -51,6 +298,4 @@ def send(recipients, subject, body):
         msg['To'] = replyto
         msg['Bcc'] = ','.join(recipients)
 
-    s = smtplib.SMTP('localhost')
-    s.sendmail(replyto, recipients, msg.as_string())
-    s.quit()
+    return msg.as_string()
@@ -0,0 +1,242 @@
+# Copyright 2017 Jonathan Anderson
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import collections
+import db
+import jinja2
+import os
+import sys
+import threading
+import time
+
+
+# Histogram buckets (in seconds), as used by the Prometheus client libraries.
+buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Requests that take longer than this many seconds are logged along with the
+# SQL they issued (0 to disable).
+slow_request = float(os.environ.get('SLOW_REQUEST_SECONDS', 1))
+
+# The most SQL statements to remember for the slow-request log.
+slow_request_queries = 100
+
+
+class Counter(object):
+    """ A count (or total) for each combination of label values. """
+
+    kind = 'counter'
+
+    def __init__(self, name, help, labels = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+
+        self._values = collections.defaultdict(float)
+        self._lock = threading.Lock()
+
+    def inc(self, amount, *labels):
+        with self._lock:
+            self._values[labels] += amount
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+
+        return [
+            (self.name, dict(zip(self.labels, labels)), value)
+            for (labels, value) in values
+        ]
+
+
+class Histogram(object):
+    """ The distribution of observed values for each combination of labels. """
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels = (), buckets = buckets):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+
+        # { labels: ( [ count per bucket ], count, sum ) }
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self._lock:
+            (counts, count, total) = self._values.get(labels,
+                    ([ 0 ] * len(self.buckets), 0, 0.0))
+
+            counts = [
+                n + 1 if value <= bound else n
+                for (n, bound) in zip(counts, self.buckets)
+            ]
+
+            self._values[labels] = (counts, count + 1, total + value)
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+
+        samples = []
+        for (labels, (counts, count, total)) in values:
+            labels = dict(zip(self.labels, labels))
+
+            for (bound, n) in zip(self.buckets, counts):
+                samples.append((self.name + '_bucket',
+                                dict(labels, le = repr(float(bound))), n))
+
+            samples += [
+                (self.name + '_bucket', dict(labels, le = '+Inf'), count),
+                (self.name + '_count', labels, count),
+                (self.name + '_sum', labels, total),
+            ]
+
+        return samples
+
+
+request_seconds = Histogram('nerfherd_request_seconds',
+    'Time taken to handle requests', ('route', 'method'))
+
+requests = Counter('nerfherd_requests_total',
+    'Requests handled', ('route', 'method', 'status'))
+
+queries = Counter('nerfherd_db_queries_total',
+    'Database queries issued', ('route',))
+
+query_seconds = Counter('nerfherd_db_query_seconds_total',
+    'Time spent waiting for database queries', ('route',))
+
+template_seconds = Histogram('nerfherd_template_render_seconds',
+    'Time taken to render templates', ('template',))
+
+mail_seconds = Histogram('nerfherd_mail_send_seconds',
+    'Time taken to send a message to a batch of recipients')
+
+all_metrics = [
+    request_seconds, requests, queries, query_seconds,
+    template_seconds, mail_seconds,
+]
+
+
+# The request (if any) being handled by the current thread.
+_request = threading.local()
+
+def start_request():
+    _request.start = time.time()
+    _request.queries = 0
+    _request.query_seconds = 0.0
+    _request.sql = []
+
+def finish_request(route, method, status, path):
+    start = getattr(_request, 'start', None)
+    if start is None:
+        return
+
+    elapsed = time.time() - start
+    _request.start = None
+
+    route = route or '(unknown)'
+    request_seconds.observe(elapsed, route, method)
+    requests.inc(1, route, method, str(status))
+    queries.inc(_request.queries, route)
+    query_seconds.inc(_request.query_seconds, route)
+
+    if slow_request and elapsed > slow_request:
+        sys.stderr.write(
+            'SLOW REQUEST: %s %s took %.3f s (status %s, %d queries, %.3f s)\n'
+            % (method, path, elapsed, status, _request.queries,
+               _request.query_seconds))
+
+        for (sql, params, seconds) in _request.sql:
+            sys.stderr.write('  %8.3f ms  %s %r\n' % (
+                seconds * 1000, sql, tuple(params or ())))
+
+        if _request.queries > len(_request.sql):
+            sys.stderr.write('  ... and %d more queries\n' % (
+                _request.queries - len(_request.sql)))
+
+def query(sql, params, seconds):
+    """ Account for a database query (see db.query_hooks). """
+    if getattr(_request, 'start', None) is None:
+        queries.inc(1, '(background)')
+        query_seconds.inc(seconds, '(background)')
+        return
+
+    _request.queries += 1
+    _request.query_seconds += seconds
+
+    if slow_request and len(_request.sql) < slow_request_queries:
+        _request.sql.append((sql, params, seconds))
+
+db.query_hooks.append(query)
+
+
+class TimedTemplate(jinja2.Template):
+    """ A template that records how long it takes to render. """
+
+    def render(self, *args, **kwargs):
+        start = time.time()
+        try: return super(TimedTemplate, self).render(*args, **kwargs)
+        finally:
+            template_seconds.observe(time.time() - start,
+                                     self.name or '(string)')
+
+
+def render(extra = ()):
+    """
+    Describe all metrics in the Prometheus text format.
+
+    extra:  more ( name, kind, help, [ ( { label: value }, value ) ] ) to
+            include, where kind is 'counter' or 'gauge': e.g., totals kept
+            by other modules or current sizes that aren't worth tracking
+            continuously
+    """
+    lines = []
+
+    for m in all_metrics:
+        lines += [
+            '# HELP %s %s' % (m.name, m.help),
+            '# TYPE %s %s' % (m.name, m.kind),
+        ]
+        lines += [ _sample(*s) for s in m.samples() ]
+
+    for (name, kind, help, samples) in extra:
+        lines += [
+            '# HELP %s %s' % (name, help),
+            '# TYPE %s %s' % (name, kind),
+        ]
+        lines += [ _sample(name, labels, value) for (labels, value) in samples ]
+
+    return '\n'.join(lines) + '\n'
+
+def _sample(name, labels, value):
+    if labels:
+        name += '{%s}' % ','.join([
+            '%s="%s"' % (k, str(v).replace('\\', r'\\').replace('"', r'\"')
+                                  .replace('\n', r'\n'))
+            for (k, v) in sorted(labels.items())
+        ])
+
+    return '%s %s' % (name, repr(float(value)))
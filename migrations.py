@@ -0,0 +1,246 @@
+# Copyright 2017 Jonathan Anderson
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+#
+# Versioned, non-destructive schema changes (see `nerfherd migrate`).
+#
+# `nerfherd init` creates the current schema from the models in db.py and
+# records every migration below as applied; `nerfherd migrate` brings an
+# existing database up to date without dropping anything. Most migrations
+# are applied (and recorded) in a transaction of their own, but on Postgres
+# indexes are built outside of a transaction (with CREATE INDEX CONCURRENTLY,
+# so that building them doesn't block registrations), so every migration
+# must be safe to re-run.
+#
+
+import collections
+import db
+import peewee
+import sys
+
+
+# transaction: whether to apply the migration in a transaction
+Migration = collections.namedtuple('Migration',
+    'version description apply transaction')
+
+# A query that ought to be answered with the help of an index.
+Plan = collections.namedtuple('Plan', 'description query index')
+
+
+def create_index(model, fields, unique = False):
+    """
+    Create an index (named as peewee names the indexes declared on models)
+    unless it already exists.
+
+    On Postgres, the index is built with CREATE INDEX CONCURRENTLY on a
+    connection of its own, so this mustn't be called within a transaction.
+
+    Returns: whether or not the index was created
+    """
+    database = db.db
+    table = model._meta.db_table
+    compiler = database.compiler()
+    name = compiler.index_name(table, [ f.db_column for f in fields ])
+    (sql, params) = compiler.create_index(model, fields, unique)
+
+    if not isinstance(database, peewee.PostgresqlDatabase):
+        if name in [ i.name for i in database.get_indexes(table) ]:
+            return False
+
+        database.execute_sql(sql, params)
+        return True
+
+    conn = _autocommit_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            'SELECT i.indisvalid FROM pg_index i'
+            ' JOIN pg_class c ON c.oid = i.indexrelid WHERE c.relname = %s',
+            (name,))
+        row = cursor.fetchone()
+
+        if row and row[0]:
+            return False
+
+        # A failed CREATE INDEX CONCURRENTLY leaves an invalid index behind.
+        if row:
+            cursor.execute('DROP INDEX CONCURRENTLY %s' % compiler.quote(name))
+
+        cursor.execute(sql.replace('INDEX', 'INDEX CONCURRENTLY', 1), params)
+
+    finally:
+        conn.close()
+
+    return True
+
+def _autocommit_connection():
+    """
+    A new Postgres connection (not one from the pool) that runs each
+    statement outside of any transaction, e.g., for CREATE INDEX CONCURRENTLY.
+    """
+    database = db.db
+    conn = peewee.PostgresqlDatabase._connect(database, database.database,
+                                              **database.connect_kwargs)
+    conn.autocommit = True
+    return conn
+
+
+def _index_lookups():
+    # Peewee indexes foreign keys when it creates a table, but databases
+    # created some other way (e.g., restored from a dump) may lack them.
+    indexes = [
+        (db.Purchase, [ db.Purchase.buyer ]),
+        (db.Purchase, [ db.Purchase.item ]),
+        (db.Payment, [ db.Payment.payer ]),
+        (db.Payment, [ db.Payment.date ]),
+        (db.Person, [ db.Person.username ]),
+        (db.Todo, [ db.Todo.assignee ]),
+        (db.Todo, [ db.Todo.complete, db.Todo.deadline ]),
+        (db.POI, [ db.POI.latitude ]),
+        (db.POI, [ db.POI.longitude ]),
+    ]
+
+    for (model, fields) in indexes:
+        create_index(model, fields)
+
+
+def _create_ledger_and_mail_queue():
+    # Databases created before these tables were added need them created
+    # and the ledger filled in from existing purchases and payments.
+    db.db.create_tables([ db.Ledger, db.QueuedMail ], safe = True)
+    db.Ledger.rebuild()
+
+
+migrations = [
+    Migration(1, 'Index foreign keys and lookup columns', _index_lookups,
+              transaction = False),
+    Migration(2, 'Create the ledger and mail queue',
+              _create_ledger_and_mail_queue, transaction = True),
+]
+
+
+def current_version():
+    """ The most recent migration applied to the database (or 0). """
+    db.db.create_tables([ db.SchemaVersion ], safe = True)
+    query = db.SchemaVersion.select(peewee.fn.MAX(db.SchemaVersion.version))
+    return query.scalar() or 0
+
+def pending():
+    """ Migrations that have not yet been applied to the database. """
+    version = current_version()
+    return [ m for m in migrations if m.version > version ]
+
+def migrate(log = None):
+    """
+    Apply every pending migration in order, recording each only once it
+    has completed.
+
+    Returns: [ Migration ]
+    """
+    applied = []
+
+    for m in pending():
+        if log:
+            log('Applying migration %d: %s\n' % (m.version, m.description))
+
+        if not m.transaction:
+            # Don't leave a transaction open on the pooled connection:
+            # CREATE INDEX CONCURRENTLY waits for every open transaction.
+            db.db.commit()
+            m.apply()
+
+        with db.db.atomic():
+            if m.transaction:
+                m.apply()
+
+            db.SchemaVersion.create(version = m.version,
+                                    description = m.description)
+
+        applied.append(m)
+
+    return applied
+
+def stamp():
+    """ Record every migration as applied (e.g., to a brand-new database). """
+    for m in pending():
+        db.SchemaVersion.create(version = m.version,
+                                description = m.description)
+
+
+def plans():
+    """ Queries from the dashboard and the views that it links to. """
+    return [
+        Plan('organizer login', db.Person.select()
+             .where(db.Person.username == 'admin'), 'person_username'),
+        Plan("an attendee's purchases", db.Purchase.select()
+             .where(db.Purchase.buyer == 1), 'purchase_buyer_id'),
+        Plan("a product's purchases", db.Purchase.select()
+             .where(db.Purchase.item == 1), 'purchase_item_id'),
+        Plan("an attendee's payments", db.Payment.select()
+             .where(db.Payment.payer == 1), 'payment_payer_id'),
+        Plan('recent payments', db.Payment.with_payers()
+             .order_by(db.Payment.date.desc()).limit(50), 'payment_date'),
+        Plan('things to do', db.Todo.with_assignees()
+             .where(db.Todo.complete == False), 'todo_complete_deadline'),
+    ]
+
+def explain(query):
+    """ The database's plan for a query, as lines of text. """
+    (sql, params) = query.sql()
+
+    if isinstance(db.db, peewee.SqliteDatabase):
+        sql = 'EXPLAIN QUERY PLAN ' + sql
+    else:
+        sql = 'EXPLAIN ' + sql
+
+    cursor = db.db.execute_sql(sql, params, require_commit = False)
+    return [ ' '.join([ str(c) for c in row ]) for row in cursor.fetchall() ]
+
+def check(log = sys.stdout.write):
+    """
+    EXPLAIN each of the plans() and check that it uses the expected index.
+
+    Returns: [ Plan ] that don't use their index
+    """
+    # With only a few rows in a table, Postgres would rather scan the table
+    # than use an index; we want to know whether it *can* use the index.
+    postgres = isinstance(db.db, peewee.PostgresqlDatabase)
+
+    with db.db.atomic():
+        if postgres:
+            db.db.execute_sql('SET LOCAL enable_seqscan = off')
+
+        failures = []
+        for p in plans():
+            plan = explain(p.query)
+            ok = any([ p.index in line for line in plan ])
+            if not ok:
+                failures.append(p)
+
+            log('%-8s %s (%s)\n' % ('ok' if ok else 'MISSING', p.description,
+                                    p.index))
+            if not ok:
+                for line in plan:
+                    log('           %s\n' % line)
+
+    return failures
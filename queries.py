@@ -0,0 +1,177 @@
+# Copyright 2017 Jonathan Anderson
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+#
+# Detection of repeated queries, e.g., the "N+1" queries that come from
+# walking a lazy relation (purchase.item, payment.payer...) inside a loop.
+#
+# In development mode (see webapp.create_app), the queries issued by each
+# request are recorded and any statement that is repeated more than
+# QUERY_REPEAT_THRESHOLD times (differing only in its parameters) is reported
+# as a warning or, if QUERY_REPEAT_RAISE is set, an error.
+#
+
+import collections
+import contextlib
+import db
+import os
+import re
+import threading
+import warnings
+
+
+repeat_threshold = int(os.environ.get('QUERY_REPEAT_THRESHOLD', 10))
+repeat_raise = bool(int(os.environ.get('QUERY_REPEAT_RAISE', 0)))
+
+Query = collections.namedtuple('Query', 'sql params seconds')
+
+
+class RepeatedQueries(UserWarning):
+    """ The same statement was run many times with different parameters. """
+    pass
+
+class TooManyQueries(AssertionError):
+    """ More queries were run than expected. """
+    pass
+
+
+_literals = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_lists = re.compile(r'\(\s*(?:\?|%s)(?:\s*,\s*(?:\?|%s))*\s*\)')
+
+def fingerprint(sql):
+    """
+    Reduce a statement to the form that it shares with other statements that
+    differ only in their parameters: literals are replaced with placeholders
+    and lists of placeholders, as in `IN (?, ?, ?)`, are collapsed.
+    """
+    sql = _literals.sub('?', sql)
+    sql = _lists.sub('(...)', sql)
+    return ' '.join(sql.split())
+
+
+class Recorder(object):
+    """
+    Records the queries that the current thread runs, e.g.:
+
+    with queries.Recorder() as r:
+        client.get('/org/')
+
+    print(r.report())
+    """
+
+    def __init__(self):
+        self.queries = []
+        self.thread = threading.current_thread()
+
+    def __call__(self, sql, params, seconds):
+        if threading.current_thread() is self.thread:
+            self.queries.append(Query(sql, params, seconds))
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        db.query_hooks.append(self)
+
+    def stop(self):
+        if self in db.query_hooks:
+            db.query_hooks.remove(self)
+
+    def fingerprints(self):
+        """ How many times each fingerprint was run: { fingerprint: count } """
+        return collections.Counter([ fingerprint(q.sql) for q in self.queries ])
+
+    def repeated(self, threshold = None):
+        """
+        Fingerprints that were run more than `threshold` times
+        (QUERY_REPEAT_THRESHOLD by default), most-repeated first.
+
+        Returns: [ ( fingerprint, count ) ]
+        """
+        if threshold is None:
+            threshold = repeat_threshold
+
+        return [
+            (f, count) for (f, count) in self.fingerprints().most_common()
+            if count > threshold
+        ]
+
+    def report(self, limit = 10):
+        """ Summarize the most-repeated statements. """
+        counts = self.fingerprints()
+        lines = [
+            '%d queries (%d distinct)' % (len(self.queries), len(counts))
+        ]
+        lines += [
+            '  %5d x %s' % (count, f) for (f, count) in counts.most_common(limit)
+        ]
+
+        return '\n'.join(lines)
+
+
+def check(recorder, context, threshold = None, fail = None):
+    """
+    Warn about (or, if `fail` or QUERY_REPEAT_RAISE is set, raise an error
+    for) any statement that `recorder` saw more than `threshold` times.
+
+    context:  what the queries were run for, e.g., 'GET /org/'
+    """
+    if fail is None:
+        fail = repeat_raise
+
+    repeated = recorder.repeated(threshold)
+    if not repeated:
+        return
+
+    message = '%s ran %s' % (context, '; '.join([
+        '%d x %s' % (count, f) for (f, count) in repeated
+    ]))
+
+    if fail:
+        raise TooManyQueries(message)
+
+    warnings.warn(message, RepeatedQueries)
+
+
+@contextlib.contextmanager
+def assert_max_queries(n, repeats = None):
+    """
+    Check that a block of code runs at most `n` queries (and, if `repeats` is
+    given, no statement more than `repeats` times), e.g.:
+
+    with queries.assert_max_queries(4):
+        client.get('/attendee/1?auth=...')
+    """
+    with Recorder() as r:
+        yield r
+
+    if len(r.queries) > n:
+        raise TooManyQueries('expected at most %d queries; %s' % (
+            n, r.report()))
+
+    if repeats is not None:
+        check(r, 'block', threshold = repeats, fail = True)
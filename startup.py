@@ -0,0 +1,113 @@
+# Copyright 2017 Jonathan Anderson
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+#
+# Measurement of how long it takes to start nerf-herder (see
+# `nerfherd startup-profile`): which modules take longest to import and how
+# long it takes to create the app.
+#
+
+import __builtin__
+import sys
+import time
+
+
+class ImportTimer(object):
+    """
+    Times every module imported while it is active, e.g.:
+
+    with ImportTimer() as t:
+        import webapp
+
+    Each module's time includes the modules that it imports in turn
+    (unless something else imported them first).
+    """
+
+    def __init__(self):
+        self.times = {}
+        self.parents = {}
+        self._stack = []
+
+    def __enter__(self):
+        self._import = __builtin__.__import__
+        __builtin__.__import__ = self._timed_import
+        return self
+
+    def __exit__(self, *exc_info):
+        __builtin__.__import__ = self._import
+
+    def total(self):
+        """ Time spent importing modules that were requested directly. """
+        return sum([ t for (m, t) in self.times.items()
+                     if self.parents[m] is None ])
+
+    def slowest(self, count = 20):
+        """ The slowest modules to import: [ ( module, parent, seconds ) ] """
+        slowest = sorted(self.times.items(), key = lambda (m, t): t,
+                         reverse = True)[:count]
+
+        return [ (m, self.parents[m], t) for (m, t) in slowest ]
+
+    def _timed_import(self, name, *args, **kwargs):
+        before = set(sys.modules)
+        if name in before:
+            return self._import(name, *args, **kwargs)
+
+        parent = self._stack[-1] if self._stack else None
+        self._stack.append(name)
+        start = time.time()
+
+        try: return self._import(name, *args, **kwargs)
+        finally:
+            elapsed = time.time() - start
+            self._stack.pop()
+
+            # Implicit relative imports (e.g., of `os` from within a
+            # package) may not load anything new: don't report them.
+            if len(sys.modules) > len(before):
+                self.times[name] = elapsed
+                self.parents[name] = parent
+
+
+def profile(count = 20, log = sys.stdout.write):
+    """
+    Import the web app and create it (as wsgi.py does), reporting how long
+    each step takes and which imports are slowest.
+
+    Returns: ( import seconds, app creation seconds )
+    """
+    with ImportTimer() as timer:
+        import webapp
+
+    start = time.time()
+    webapp.create_app(dev_mode = False)
+    create = time.time() - start
+
+    log('Importing webapp:  %8.1f ms\n' % (timer.total() * 1000))
+    log('Creating the app:  %8.1f ms\n' % (create * 1000))
+    log('\nSlowest imports (including the modules that they import):\n')
+    for (module, parent, seconds) in timer.slowest(count):
+        log('  %8.1f ms  %-28s %s\n' % (seconds * 1000, module,
+            ('(from %s)' % parent) if parent else ''))
+
+    return (timer.total(), create)
@@ -0,0 +1,87 @@
+# Copyright 2017 Jonathan Anderson
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+#
+# Tests run against a scratch SQLite database with environment-only
+# configuration, which has to be set up before anything imports config or db.
+# Run them from the top-level directory with:
+#
+#   python -m unittest discover
+#
+
+import atexit
+import base64
+import os
+import tempfile
+
+(_fd, database_file) = tempfile.mkstemp(suffix = '.db')
+os.close(_fd)
+atexit.register(os.remove, database_file)
+
+os.environ['DATABASE_URL'] = 'sqlite://' + database_file
+os.environ['REGISTRATION_IS_OPEN'] = '1'
+os.environ.setdefault('SECRET_KEY', 'not very secret')
+os.environ.setdefault('SITE_TITLE', 'Test DevSummit')
+os.environ.setdefault('MAIL_REPLYTO', 'organizers@example.com')
+
+
+def reset_database():
+    """ Re-create the (empty) scratch database and forget cached pages. """
+    import cache
+    import db
+
+    db.init()
+    db.Product.update(cost = 6500).where(db.Product.name == 'Registration') \
+              .execute()
+    db.Product._registration_id = None
+    db.db.close()
+
+    cache.invalidate()
+
+def register(name, **fields):
+    """ Register an attendee (the first of whom is an administrator). """
+    import db
+
+    username = name.lower().replace(' ', '')
+    fields.setdefault('username', username)
+    fields.setdefault('email', '%s@example.com' % username)
+    fields.setdefault('address', '1 Test Street')
+
+    return db.Person.register(name = name, **fields)
+
+def create_app():
+    import webapp
+
+    app = webapp.create_app(dev_mode = False)
+    app.config['TESTING'] = True
+    app.config['WTF_CSRF_ENABLED'] = False
+    app.secret_key = 'not very secret'
+
+    return app
+
+def organizer(person):
+    """ HTTP headers to authenticate as an administrator. """
+    return {
+        'Authorization': 'Basic ' + base64.b64encode(
+            '%s:%s' % (person.username, person.auth())),
+    }
@@ -0,0 +1,172 @@
+# Copyright 2017 Jonathan Anderson
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import db
+import imports
+import json
+import StringIO
+import tests
+import unittest
+
+
+def point(title, longitude, latitude, **properties):
+    properties['title'] = title
+    return {
+        'type': 'Feature',
+        'geometry': { 'type': 'Point', 'coordinates': [ longitude, latitude ] },
+        'properties': properties,
+    }
+
+
+class ImportPOITest(unittest.TestCase):
+    """ Importing POIs from GeoJSON. """
+
+    def setUp(self):
+        tests.reset_database()
+
+    def run_import(self, features):
+        document = json.dumps({ 'type': 'FeatureCollection',
+                                'features': features })
+
+        records = imports.records(StringIO.StringIO(document), 'poi.geojson')
+        return imports.import_poi(records, icon = 'default.png')
+
+    def test_malformed_features(self):
+        result = self.run_import([
+            point('Kitchen', 0.12, 52.2),
+            'not a feature',
+            { 'type': 'Feature', 'geometry': None },
+            { 'type': 'Feature', 'properties': [ 'title' ] },
+            { 'type': 'Feature', 'properties': { 'title': 'Nowhere' },
+              'geometry': { 'type': 'Point' } },
+            { 'type': 'Feature', 'properties': { 'title': 'Somewhere' },
+              'geometry': { 'type': 'Point', 'coordinates': [ 'a', 'b' ] } },
+            { 'type': 'Feature', 'properties': { 'title': 'Flat' },
+              'geometry': { 'type': 'Point', 'coordinates': 52 } },
+        ])
+
+        self.assertEqual(result.created, 1)
+        self.assertEqual([ where for (where, _) in result.errors ], [
+            'record 2', 'feature 3', 'feature 4',
+            'feature 5', 'feature 6', 'feature 7',
+        ])
+
+    def test_not_a_collection(self):
+        records = imports.records(StringIO.StringIO('42'), 'poi.json')
+        self.assertRaises(ValueError, imports.import_poi, records)
+
+    def test_malformed_csv(self):
+        records = imports.records(StringIO.StringIO('title\n"a\0b"\n'),
+                                  'poi.csv')
+        self.assertRaises(ValueError, imports.import_poi, records)
+
+    def test_updates(self):
+        extra = imports.update_size + 1
+
+        self.run_import([
+            point('Kitchen', 0.12, 52.2, description = 'Food'),
+            point('Pub', 0.13, 52.3, icon = 'pub.png'),
+        ])
+
+        result = self.run_import(
+            [ point('Kitchen', 0.14, 52.4), point('Pub', 0.15, 52.5,
+                                                  description = 'Beer') ] +
+            [ point('Extra %d' % i, 0, 0) for i in range(extra) ]
+        )
+        self.assertEqual((result.created, result.updated, result.errors),
+                         (extra, 2, []))
+
+        # More updates than fit in one statement:
+        result = self.run_import(
+            [ point('Extra %d' % i, 1, 1) for i in range(extra) ])
+        self.assertEqual((result.created, result.updated), (0, extra))
+
+        kitchen = db.POI.get(title = 'Kitchen')
+        self.assertEqual((kitchen.longitude, kitchen.latitude), (0.14, 52.4))
+        self.assertEqual(kitchen.description, 'Food')
+        self.assertEqual(kitchen.icon, 'default.png')
+
+        pub = db.POI.get(title = 'Pub')
+        self.assertEqual((pub.longitude, pub.latitude), (0.15, 52.5))
+        self.assertEqual(pub.description, 'Beer')
+        self.assertEqual(pub.icon, 'default.png')
+
+        self.assertEqual(
+            db.POI.select().where(db.POI.longitude == 1).count(), extra)
+
+    def test_parameter_limit(self):
+        parameters = []
+        hook = lambda sql, params, seconds: parameters.append(len(params or ()))
+
+        db.query_hooks.append(hook)
+        try:
+            result = self.run_import([
+                point('POI %d' % i, 0, 0, description = 'Somewhere')
+                for i in range(imports.max_parameters)
+            ])
+
+        finally:
+            db.query_hooks.remove(hook)
+
+        self.assertEqual(result.created, imports.max_parameters)
+        self.assertLessEqual(max(parameters), imports.max_parameters)
+
+
+class ImportAttendeesTest(unittest.TestCase):
+    """ Registering attendees from a CSV file. """
+
+    def setUp(self):
+        tests.reset_database()
+
+    def test_parameter_limit(self):
+        count = imports.max_parameters
+        rows = [ 'name,username,shirt' ] + [
+            'Attendee %d,attendee%d,%s' % (i, i, 'M/L' if i % 2 else '')
+            for i in range(count)
+        ]
+
+        parameters = []
+        hook = lambda sql, params, seconds: parameters.append(len(params or ()))
+
+        db.query_hooks.append(hook)
+        try:
+            records = imports.records(StringIO.StringIO('\n'.join(rows)),
+                                      'attendees.csv')
+            result = imports.import_attendees(records)
+
+        finally:
+            db.query_hooks.remove(hook)
+
+        self.assertEqual((result.created, result.errors), (count, []))
+        self.assertLessEqual(max(parameters), imports.max_parameters)
+
+        self.assertEqual(db.Person.select().count(), count)
+        self.assertEqual(db.Ledger.select().count(), count)
+        self.assertEqual(db.Purchase.select().count(), count + count // 2)
+        self.assertEqual(
+            db.Purchase.select().where(db.Purchase.complimentary).count(),
+            count // 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
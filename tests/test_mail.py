@@ -0,0 +1,163 @@
+# Copyright 2017 Jonathan Anderson
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import asyncore
+import db
+import mail
+import smtpd
+import tests
+import threading
+import time
+import unittest
+
+
+class Server(smtpd.SMTPServer):
+    """ A local SMTP server that counts connections and messages. """
+
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+
+        self.address = '%s:%d' % self.socket.getsockname()
+        self.channels = []
+        self.messages = []
+
+        self._running = True
+        self._thread = threading.Thread(target = self._serve)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            (conn, addr) = pair
+            self.channels.append(smtpd.SMTPChannel(self, conn, addr))
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.messages.append(rcpttos)
+
+    def drop_connections(self):
+        for channel in self.channels:
+            channel.close()
+
+        time.sleep(0.1)
+
+    def stop(self):
+        self._running = False
+        self._thread.join()
+        self.close()
+
+    def _serve(self):
+        while self._running:
+            asyncore.loop(timeout = 0.01, count = 1)
+
+
+class TransportTest(unittest.TestCase):
+    def setUp(self):
+        self.server = Server()
+        self.original = (mail.transport, mail.batch_size)
+        mail.transport = mail.Transport(self.server.address)
+        mail.batch_size = 2
+
+    def tearDown(self):
+        mail.transport.close()
+        (mail.transport, mail.batch_size) = self.original
+        self.server.stop()
+
+    def test_batches_share_a_connection(self):
+        recipients = [ 'attendee%d@example.com' % i for i in range(5) ]
+        batches = mail.send(recipients, 'Hello', 'Hello, everyone!')
+
+        self.assertEqual([ b.recipients for b in batches ], [ 2, 2, 1 ])
+        self.assertEqual(len(self.server.messages), 3)
+        self.assertEqual(sorted(sum(self.server.messages, [])),
+                         sorted(recipients))
+        self.assertEqual(len(self.server.channels), 1)
+
+    def test_reconnects_after_a_dropped_connection(self):
+        mail.send([ 'first@example.com' ], 'Hello', 'First message')
+        self.server.drop_connections()
+        mail.send([ 'second@example.com' ], 'Hello', 'Second message')
+
+        self.assertEqual(self.server.messages, [
+            [ 'first@example.com' ], [ 'second@example.com' ]
+        ])
+        self.assertEqual(len(self.server.channels), 2)
+
+
+class MailAllTest(unittest.TestCase):
+    """ Queuing a personalised message for every attendee. """
+
+    def setUp(self):
+        tests.reset_database()
+        self.organizer = tests.register('Organizer')
+        self.attendees = [ tests.register('Attendee %d' % i) for i in range(3) ]
+        db.db.close()
+
+        self.client = tests.create_app().test_client()
+
+    def mail_all(self, body):
+        return self.client.post('/org/attendees/mail-all',
+            headers = tests.organizer(self.organizer),
+            data = { 'subject': 'Hello', 'body': body },
+        )
+
+    def bodies(self):
+        return dict(
+            db.QueuedMail.select(db.QueuedMail.recipients, db.QueuedMail.body)
+                         .tuples()
+        )
+
+    def test_purchases(self):
+        self.mail_all('You bought:\n{{ purchases }}')
+
+        p = self.attendees[0]
+        self.assertEqual(self.bodies()[p.email],
+                         'You bought:\n1 x %s: %s' % (
+                             db.Product.get(name = 'Registration'),
+                             db.Money(6500)))
+
+    def test_link(self):
+        self.mail_all('{{ link }}')
+
+        p = self.attendees[0]
+        link = self.bodies()[p.email]
+        self.assertEqual(link, 'http://localhost/attendee/%d?auth=%s' % (
+            p.id, p.auth()))
+
+        response = self.client.get(link)
+        self.assertEqual(response.status_code, 200)
+
+    def test_all_or_nothing(self):
+        def messages():
+            for i in range(5):
+                yield ('attendee%d@example.com' % i, 'Hello', 'Hello!')
+
+            raise ValueError('template error')
+
+        self.assertRaises(ValueError, mail.enqueue_many, messages(),
+                          chunk_size = 2)
+        self.assertEqual(db.QueuedMail.select().count(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
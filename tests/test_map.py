@@ -0,0 +1,75 @@
+# Copyright 2017 Jonathan Anderson
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import db
+import geo
+import json
+import tests
+import unittest
+
+
+class PointsOfInterestTest(unittest.TestCase):
+    """ The GeoJSON feed behind the map. """
+
+    def setUp(self):
+        tests.reset_database()
+        for (i, title) in enumerate([ 'Kitchen', 'Pub' ]):
+            db.POI.create(title = title, icon = 'icon.png',
+                latitude = 52.2 + i * 0.001, longitude = 0.12)
+        db.db.close()
+        geo.index.clear()
+
+        self.client = tests.create_app().test_client()
+
+    def features(self, query):
+        response = self.client.get('/map/poi.geojson?' + query)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.get_data())['features']
+
+    def test_zoomed_in(self):
+        features = self.features('zoom=18')
+        self.assertEqual(len(features), 2)
+
+    def test_whole_world(self):
+        features = self.features('bbox=-180,-90,180,90&zoom=0')
+        self.assertEqual(len(features), 1)
+        self.assertEqual(features[0]['properties']['count'], 2)
+
+    def test_zoom_range(self):
+        self.assertEqual(len(self.features('zoom=-2000')), 1)
+        self.assertEqual(len(self.features('zoom=2000')), 2)
+
+    def test_wrapped_world(self):
+        features = self.features('bbox=-540,-85,540,85&zoom=0')
+        self.assertEqual(features[0]['properties']['count'], 2)
+
+    def test_invalid(self):
+        for query in ('bbox=nan,0,1,1&zoom=3', 'bbox=0,0,inf,1',
+                      'bbox=0,-91,1,1', 'bbox=1,0,0,1', 'bbox=0,1,1,0',
+                      'bbox=0,0,1', 'zoom=1e9999'):
+            response = self.client.get('/map/poi.geojson?' + query)
+            self.assertEqual(response.status_code, 400, query)
+
+
+if __name__ == '__main__':
+    unittest.main()
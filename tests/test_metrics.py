@@ -0,0 +1,59 @@
+# Copyright 2017 Jonathan Anderson
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import db
+import tests
+import unittest
+
+
+class MetricsTest(unittest.TestCase):
+    """ The Prometheus metrics at /org/metrics. """
+
+    def setUp(self):
+        tests.reset_database()
+        self.organizer = tests.register('Organizer')
+        db.db.close()
+
+        self.client = tests.create_app().test_client()
+
+    def test_types(self):
+        response = self.client.get('/org/metrics',
+                                   headers = tests.organizer(self.organizer))
+        self.assertEqual(response.status_code, 200)
+
+        types = dict(
+            line.split()[2:4] for line in response.get_data().splitlines()
+            if line.startswith('# TYPE ')
+        )
+
+        for name in ('checkouts', 'wait_seconds', 'timeouts'):
+            self.assertEqual(types['nerfherd_db_pool_%s_total' % name],
+                             'counter')
+
+        self.assertEqual(types['nerfherd_db_pool_connections'], 'gauge')
+        self.assertEqual(types['nerfherd_mail_queue'], 'gauge')
+        self.assertEqual(types['nerfherd_requests_total'], 'counter')
+
+
+if __name__ == '__main__':
+    unittest.main()
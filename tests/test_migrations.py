@@ -0,0 +1,73 @@
+# Copyright 2017 Jonathan Anderson
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import db
+import migrations
+import tests
+import unittest
+
+
+class MigrationTest(unittest.TestCase):
+    """ Bringing an older database up to date with `nerfherd migrate`. """
+
+    def setUp(self):
+        tests.reset_database()
+
+        # Start from a database that predates the indexes and the ledger:
+        db.SchemaVersion.drop_table(fail_silently = True)
+        db.db.drop_tables([ db.Ledger ])
+        db.db.execute_sql('DROP INDEX person_username')
+
+        self.migrations = migrations.migrations[:]
+
+    def tearDown(self):
+        migrations.migrations[:] = self.migrations
+        db.db.close()
+
+    def indexes(self, model):
+        return [ i.name for i in db.db.get_indexes(model._meta.db_table) ]
+
+    def test_migrate(self):
+        applied = migrations.migrate()
+
+        self.assertEqual([ m.version for m in applied ], [ 1, 2 ])
+        self.assertEqual(migrations.current_version(), 2)
+        self.assertIn('person_username', self.indexes(db.Person))
+        self.assertTrue(db.Ledger.table_exists())
+
+        self.assertEqual(migrations.migrate(), [])
+
+    def test_failed_migration(self):
+        def fail():
+            raise RuntimeError('interrupted')
+
+        migrations.migrations[1:] = [
+            migrations.Migration(2, 'Fail', fail, transaction = False),
+        ]
+
+        self.assertRaises(RuntimeError, migrations.migrate)
+        self.assertEqual(migrations.current_version(), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+# Copyright 2017 Jonathan Anderson
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import db
+import tests
+import unittest
+
+
+# bounds() pads the box by two arcseconds on every side.
+margin = 2.0 / 3600
+
+
+class BoundsTest(unittest.TestCase):
+    """ The bounding boxes computed by POI.bounds(). """
+
+    def setUp(self):
+        tests.reset_database()
+        db.POI.changed()
+
+        for (title, longitude, latitude) in (
+                ('Room 1', 0.10, 52.20), ('Room 2', 0.12, 52.21),
+                ('Pub', -1.0, 51.0)):
+            db.POI.create(title = title, icon = 'icon.png',
+                          longitude = longitude, latitude = latitude)
+
+    def tearDown(self):
+        db.db.close()
+
+    def assertBounds(self, bounds, expected):
+        for (actual, value) in zip(bounds, expected):
+            self.assertAlmostEqual(actual, value)
+
+    def test_all(self):
+        self.assertBounds(db.POI.bounds(), (
+            -1.0 - margin, 51.0 - margin, 0.12 + margin, 52.21 + margin))
+
+    def test_criteria(self):
+        self.assertBounds(db.POI.bounds(db.POI.title.startswith('Room ')), (
+            0.10 - margin, 52.20 - margin, 0.12 + margin, 52.21 + margin))
+
+    def test_nothing(self):
+        self.assertBounds(db.POI.bounds(db.POI.title == 'Nowhere'), (
+            180 - margin, 90 - margin, -180 + margin, -90 + margin))
+
+    def test_changes(self):
+        rooms = db.POI.title.startswith('Room ')
+        db.POI.bounds(rooms)
+
+        db.POI.create(title = 'Room 3', icon = 'icon.png',
+                      longitude = 0.2, latitude = 52.3)
+        self.assertBounds(db.POI.bounds(rooms), (
+            0.10 - margin, 52.20 - margin, 0.2 + margin, 52.3 + margin))
+
+        # Bulk changes bypass save(), so they need POI.changed():
+        db.POI.update(longitude = 0.3).where(db.POI.title == 'Room 3') \
+              .execute()
+        self.assertAlmostEqual(db.POI.bounds(rooms)[2], 0.2 + margin)
+
+        db.POI.changed()
+        self.assertAlmostEqual(db.POI.bounds(rooms)[2], 0.3 + margin)
+
+
+if __name__ == '__main__':
+    unittest.main()
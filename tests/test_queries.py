@@ -0,0 +1,92 @@
+# Copyright 2017 Jonathan Anderson
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import datetime
+import db
+import queries
+import tests
+import unittest
+
+
+class QueryCountTest(unittest.TestCase):
+    """
+    Pages should take a fixed number of queries, however many attendees,
+    purchases and payments they show.
+    """
+
+    def setUp(self):
+        tests.reset_database()
+
+        self.organizer = tests.register('Organizer')
+        products = [
+            db.Product.create(name = 'Product %d' % i,
+                              description = 'Product %d' % i, cost = 100 * i)
+            for i in range(1, 4)
+        ]
+
+        self.attendees = [
+            tests.register('Attendee %d' % i, host = self.organizer.id)
+            for i in range(10)
+        ]
+
+        today = datetime.date.today()
+        for p in self.attendees:
+            for item in products:
+                db.Purchase.create(buyer = p, item = item, quantity = 2,
+                                   date = today)
+
+            for value in (100, 200):
+                db.Payment.create(payer = p, date = today, value = value)
+
+        db.db.close()
+
+        self.client = tests.create_app().test_client()
+
+    def test_attendee_page(self):
+        p = self.attendees[0]
+
+        with queries.assert_max_queries(4):
+            response = self.client.get('/attendee/%d?auth=%s' % (
+                p.id, p.auth()))
+
+        self.assertEqual(response.status_code, 200)
+
+    def assert_org_page(self, path, n):
+        with queries.assert_max_queries(n):
+            response = self.client.get(path,
+                headers = tests.organizer(self.organizer))
+
+        self.assertEqual(response.status_code, 200)
+
+    def test_dashboard(self):
+        self.assert_org_page('/org/', 8)
+
+    def test_attendees(self):
+        self.assert_org_page('/org/attendees/', 5)
+
+    def test_payments(self):
+        self.assert_org_page('/org/payments/', 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+# Copyright 2017 Jonathan Anderson
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import db
+import tests
+import threading
+import unittest
+
+
+class ParallelRegistrationTest(unittest.TestCase):
+    """ People registering at the same time as each other. """
+
+    threads = db.pool_size
+
+    def setUp(self):
+        tests.reset_database()
+
+    def test_one_administrator(self):
+        start = threading.Event()
+        errors = []
+
+        def register(i):
+            start.wait()
+            try: tests.register('Attendee %d' % i)
+            except Exception, e: errors.append(e)
+            finally: db.db.close()
+
+        threads = [
+            threading.Thread(target = register, args = (i,))
+            for i in range(self.threads)
+        ]
+
+        for t in threads: t.start()
+        start.set()
+        for t in threads: t.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(db.Person.select().count(), self.threads)
+        self.assertEqual(
+            db.Person.select().where(db.Person.administrator == True).count(),
+            1)
+        self.assertEqual(
+            db.Purchase.select()
+                       .where(db.Purchase.item == db.Product.registration_id())
+                       .count(),
+            self.threads)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+# Copyright 2017 Jonathan Anderson
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import db
+import os
+import shutil
+import tempfile
+import tests
+import unittest
+
+
+class ReplicaTest(unittest.TestCase):
+    """ Reads from a replica (a copy of the primary's SQLite file). """
+
+    def setUp(self):
+        tests.reset_database()
+        self.organizer = tests.register('Organizer')
+        db.db.close()
+
+        # The replica is a snapshot of the primary, so it won't know about
+        # anyone who registers from here on.
+        (fd, self.replica_file) = tempfile.mkstemp(suffix = '.db')
+        os.close(fd)
+        shutil.copy(tests.database_file, self.replica_file)
+
+        self.replica = db.open_database('sqlite://' + self.replica_file)
+        db.replicas[:] = [ self.replica ]
+
+        self.app = tests.create_app()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.replicas[:] = []
+        if not self.replica.is_closed():
+            self.replica.close()
+
+        os.remove(self.replica_file)
+
+    def attendee_page(self, person):
+        return self.client.get('/attendee/%d?auth=%s' % (
+            person.id, person.auth()))
+
+    def test_read_only_views_use_the_replica(self):
+        response = self.client.get('/org/',
+                                   headers = tests.organizer(self.organizer))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.replica.stats()['checkouts'], 1)
+
+        # Someone the replica hasn't heard of yet:
+        late = tests.register('Late Registrant')
+        db.db.close()
+
+        self.assertEqual(self.attendee_page(late).status_code, 401)
+        self.assertEqual(self.replica.stats()['checkouts'], 2)
+
+    def test_writers_read_from_the_primary(self):
+        shirt = db.Product.get(db.Product.name.startswith('Shirt (')).id
+        db.db.close()
+
+        response = self.client.post('/register', data = {
+            'name': 'New Attendee',
+            'username': 'new',
+            'email': 'new@example.com',
+            'address': '1 Test Street',
+            'host': '-1',
+            'shirt_style': str(shirt),
+            'dietary_needs': '',
+        })
+        self.assertEqual(response.status_code, 302)
+
+        new = db.Person.get(username = 'new')
+        db.db.close()
+
+        self.assertEqual(self.attendee_page(new).status_code, 200)
+        self.assertEqual(self.replica.stats()['checkouts'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
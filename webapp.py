@@ -21,7 +21,9 @@
 # OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import cache
 import config
+import csv
 import datetime
 import db
 import flask
@@ -29,15 +31,28 @@ import flask_bootstrap
 import flask_dotenv
 import flask_httpauth
 import forms
+import functools
+import geo
 import jinja2
-import mail
+import math
+import metrics
 import nav
+import operator
+import os
+import queries
 import sys
+import time
+import warnings
 
 auth = flask_httpauth.HTTPBasicAuth()
 database = db.db
 frontend = flask.Blueprint('nerf-herder frontend', __name__)
 
+# In production mode, compiled templates are kept in this directory (or, by
+# default, a per-user temporary directory) so that they can be shared by
+# all of the workers and precompiled by `nerfherd compile-templates`.
+template_cache_dir = os.environ.get('TEMPLATE_CACHE_DIR')
+
 
 @auth.error_handler
 def auth_error():
@@ -54,7 +69,7 @@ def verify_auth(username, password):
         sys.stderr.write("ERROR: %s is not an administrator\n" % username)
         return False
 
-    if password != p.auth():
+    if not p.check_auth(password):
         sys.stderr.write("ERROR: %s used incorrect password\n" % username)
         return False
 
@@ -62,14 +77,172 @@ def verify_auth(username, password):
 
 
 @frontend.before_request
-def _db_connect():
-    database.connect()
+def _start_metrics():
+    metrics.start_request()
+
+@frontend.after_request
+def _response_status(response):
+    flask.g.status = response.status_code
+    return response
+
+@frontend.teardown_request
+def _finish_metrics(exc):
+    request = flask.request
+    rule = request.url_rule.rule if request.url_rule else None
+    status = 500 if exc else flask.g.get('status', 500)
 
+    metrics.finish_request(rule, request.method, status, request.path)
+
+# Connections are checked out of the pool (see db.Pool) by a request's first
+# query, so that requests served from the page cache don't need one at all.
 @frontend.teardown_request
 def _db_close(exc):
+    # Return this request's connection (if any) to the pool:
     if not database.is_closed():
         database.close()
 
+    db.router.release()
+
+
+# In development mode, each request's queries are checked for statements that
+# are repeated over and over (see queries.py and create_app below).
+def _record_queries():
+    flask.g.queries = queries.Recorder()
+    flask.g.queries.start()
+
+def _check_queries(response):
+    recorder = flask.g.pop('queries', None)
+    if recorder:
+        recorder.stop()
+        queries.check(recorder, '%s %s' % (
+            flask.request.method, flask.request.path))
+
+    return response
+
+def _stop_recording(exc):
+    recorder = flask.g.pop('queries', None)
+    if recorder:
+        recorder.stop()
+
+
+def read_only(view):
+    """
+    Serve a view that doesn't write anything from a read replica
+    (if there are any), unless this client has written something recently
+    and may not see it on the replica yet.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if flask.session.get('primary-until', 0) < time.time():
+            db.router.read_from_replica()
+
+        return view(*args, **kwargs)
+
+    return wrapper
+
+def cached(view):
+    """
+    Serve a public page from the page cache (see cache.py), only rendering
+    it if it isn't already there.
+
+    Cached pages are rendered from the primary database rather than a replica
+    so that a lagging replica can't put a stale page back in the cache just
+    after it has been invalidated.
+
+    Pages are cached by path alone, so that clients can't push real pages out
+    of the cache by requesting them with made-up query strings: only use this
+    for views that don't read any query parameters.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        # Flashed messages are meant for one client only:
+        if '_flashes' in flask.session:
+            return view(*args, **kwargs)
+
+        key = flask.request.path
+        page = cache.pages.get(key)
+
+        if page is None:
+            response = flask.make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+
+            page = cache.page(response.get_data(), response.content_type)
+            cache.pages.put(key, page)
+
+        response = flask.Response(page.body, content_type = page.content_type)
+        response.set_etag(page.etag)
+        response.last_modified = page.modified
+        response.cache_control.public = True
+        response.cache_control.no_cache = True
+
+        return response.make_conditional(flask.request)
+
+    return wrapper
+
+def stick_to_primary():
+    """ Read this client's own writes back from the primary database. """
+    if db.replicas:
+        flask.session['primary-until'] = time.time() + db.replica_lag
+
+
+
+def paginate(query, sort_keys, default, search = ()):
+    """
+    Fetch one page of a query according to the request's arguments:
+
+      sort:           name of the key to sort by (prefix with '-' to reverse)
+      q:              text to search for
+      limit:          number of rows per page
+      after, before:  page cursors (see db.Page)
+
+    sort_keys:  { name: Field } that the results may be sorted by
+    default:    the default `sort` argument
+    search:     text fields to search for `q` in
+    """
+    args = flask.request.args
+
+    sort = args.get('sort', default)
+    if sort.lstrip('-') not in sort_keys:
+        sort = default
+
+    search_text = args.get('q', '')
+    if search_text and search:
+        query = query.where(functools.reduce(operator.or_, [
+            field.contains(search_text) for field in search
+        ]))
+
+    limit = min(max(args.get('limit', PAGE_SIZE, type = int), 1), MAX_PAGE_SIZE)
+    key = sort_keys[sort.lstrip('-')]
+    descending = sort.startswith('-')
+
+    try:
+        page = db.Page(query, key, descending, limit,
+                       after = args.get('after'), before = args.get('before'))
+
+    except ValueError:
+        page = db.Page(query, key, descending, limit)
+
+    page.sort = sort
+    page.search = search_text
+    page.searchable = len(search) > 0
+    page.url = page_url
+
+    return page
+
+def page_url(**changes):
+    """ The current URL, with a different page, sort order, etc. """
+    args = flask.request.args.to_dict()
+    args.pop('after', None)
+    args.pop('before', None)
+    args.update(changes)
+
+    return flask.url_for(flask.request.endpoint, **dict(
+        (k, v) for (k, v) in args.items() if v not in (None, '')
+    ))
+
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
 
 
 def render_error(code, message, *args):
@@ -90,6 +263,7 @@ def render_error(code, message, *args):
 
 
 @frontend.route('/')
+@cached
 def index():
     try: return flask.render_template('index.html')
     except jinja2.exceptions.TemplateNotFound:
@@ -109,12 +283,16 @@ def index():
 
 
 @frontend.route('/attendee/<int:id>')
+@read_only
 def attendee(id):
     try:
-        p = db.Person.get(id = id)
-        if flask.request.args.get('auth') == p.auth():
+        p = db.Person.with_accounts().where(db.Person.id == id).get()
+        if p.check_auth(flask.request.args.get('auth')):
+            (purchases, payments) = p.history()
+
             return flask.render_template('attendee.html',
-                attendee = p, products = db.Product.select())
+                attendee = p, purchases = purchases, payments = payments,
+                products = db.Product.select())
 
     except db.Person.DoesNotExist:
         pass
@@ -135,7 +313,7 @@ def buy():
         buyer = db.Person.get(id = buyer_id)
 
         auth_code = flask.request.args.get('auth')
-        if auth_code == buyer.auth():
+        if buyer.check_auth(auth_code):
             db.Purchase.create(
                 buyer = buyer,
                 item = item,
@@ -143,6 +321,7 @@ def buy():
                 date = datetime.datetime.now()
             )
 
+            stick_to_primary()
             return flask.redirect('/attendee/%d?auth=%s' % (
                     buyer.id, buyer.auth()
             ))
@@ -152,6 +331,7 @@ def buy():
 
 
 @frontend.route('/map/')
+@cached
 def map():
     return flask.render_template('map.html',
         poi = db.POI.select(),
@@ -159,6 +339,43 @@ def map():
     )
 
 
+@frontend.route('/map/poi.geojson')
+def map_poi():
+    args = flask.request.args
+
+    try:
+        bbox = args.get('bbox') or None
+        if bbox is not None:
+            bbox = [ float(x) for x in bbox.split(',') ]
+            if len(bbox) != 4:
+                raise ValueError('expected four coordinates')
+
+            if any(math.isinf(x) or math.isnan(x) for x in bbox):
+                raise ValueError('coordinates must be finite')
+
+            (min_lon, min_lat, max_lon, max_lat) = bbox
+            if not -90 <= min_lat <= max_lat <= 90:
+                raise ValueError('expected latitudes from -90 to 90, min first')
+
+            if min_lon > max_lon:
+                raise ValueError('expected the minimum longitude first')
+
+            # Leaflet's bounds go beyond 180 degrees when the world wraps.
+            bbox = [ max(min_lon, -180.0), min_lat,
+                     min(max_lon, 180.0), max_lat ]
+
+        zoom = args.get('zoom') or None
+        if zoom is not None:
+            # POIs are clustered below cluster_zoom and not at all above it.
+            zoom = min(max(int(zoom), 0), geo.cluster_zoom)
+
+    except ValueError, e:
+        return render_error(400, 'Invalid bounding box or zoom level: %s' % e,
+            'example: /map/poi.geojson?bbox=0.09,52.19,0.14,52.22&zoom=14')
+
+    return flask.jsonify(geo.index.features(bbox, zoom))
+
+
 @frontend.route('/register', methods = [ 'GET', 'POST' ])
 def register():
     if not config.REGISTRATION_IS_OPEN:
@@ -186,10 +403,8 @@ def register():
                 host = None
 
             try:
-                shirt = db.Product.get(id = form.shirt_style.data)
-
-                # Create the person in the database:
-                p = db.Person.create(
+                p = db.Person.register(
+                    shirt = form.shirt_style.data,
                     name = form.name.data,
                     username = form.username.data,
                     host = host,
@@ -200,44 +415,28 @@ def register():
                     dietary_needs = form.dietary_needs.data,
                 )
 
-                if db.Person.select().count() == 1:
+                if p.administrator:
                     flask.flash('''You are the first registrant;
                         granting administrative privileges''')
-                    p.administrator = True
-                    p.save()
-
-                # Buy the "registration" product:
-                registration = db.Product.get(name = 'Registration')
-                db.Purchase.create(
-                    buyer = p,
-                    item = registration,
-                    quantity = 1,
-                    date = datetime.datetime.now()
-                )
-
-                # Get them a shirt:
-                db.Purchase.create(
-                    buyer = p,
-                    item = shirt,
-                    quantity = 1,
-                    date = datetime.datetime.now(),
-                    complimentary = True
-                )
 
                 flask.flash('Registration successful!')
 
-                mail.send([ p.email ],
+                # Mail (and smtplib, etc.) is only needed by a few views:
+                import mail
+                mail.enqueue([ p.email ],
                         subject = '%s registration' % config.SITE_TITLE,
                         body = flask.render_template(
                                 'registration-email.txt', attendee = p)
                 )
 
+                stick_to_primary()
                 return flask.redirect('/attendee/%d?auth=%s' % (
                         p.id, p.auth()
                 ))
 
-            except db.Product.NotFoundError, e:
-                flask.flash('Invalid shirt style')
+            except db.Product.DoesNotExist, e:
+                flask.flash(u"Error: registration isn't available yet",
+                            'error')
 
             except db.peewee.IntegrityError, e:
                 flask.flash(u"Error: %s (have you already registered?)" % e,
@@ -255,12 +454,14 @@ def register():
 
 @frontend.route('/org/')
 @auth.login_required
+@read_only
 def admin():
-    bookings = db.Product.select().where(db.Product.cost == 0)
-    products = db.Product.select().where(db.Product.cost > 0)
+    products = list(db.Product.with_statistics())
+    bookings = [ p for p in products if p.cost == 0 ]
+    products = [ p for p in products if p.cost > 0 ]
     total_purchases = sum([ p.all_purchases() for p in products ])
 
-    payments = db.Payment.select().order_by(db.Payment.date.desc())
+    payments = db.Payment.with_payers().order_by(db.Payment.date.desc())
 
     balances = db.Person.balances()
     balance = sum(balances.values())
@@ -274,7 +475,7 @@ def admin():
         bookings = bookings,
         payments = payments,
         products = products,
-        todos = db.Todo.select().where(db.Todo.complete == False),
+        todos = db.Todo.with_assignees().where(db.Todo.complete == False),
         total_payments = sum([ p.amount() for p in payments ]),
         total_purchases = total_purchases,
         prereg = flask.current_app.config['PREREGISTRATION_CODE'],
@@ -283,28 +484,83 @@ def admin():
 @frontend.route('/org/attendees/')
 @auth.login_required
 def admin_attendees():
-    hosts = db.Person.select()
+    choices = forms.host_choices(
+            db.Person.select(db.Person.id, db.Person.name))
+
+    page = paginate(db.Person.with_accounts(),
+        sort_keys = {
+            'id': db.Person.id,
+            'name': db.Person.name,
+            'email': db.Person.email,
+            'arrival': db.Person.arrival,
+        },
+        default = 'name',
+        search = (db.Person.name, db.Person.username, db.Person.email),
+    )
+
+    new_person = forms.AttendeeForm(obj = None)
+    new_person.host.choices = choices
 
     return flask.render_template('admin/attendees.html',
         config = config,
         attendees = [
-            (p, forms.AttendeeUpdate.for_person(p, hosts))
-            for p in db.Person.select()
+            (p, forms.AttendeeUpdate.for_person(p, choices)) for p in page
         ],
-        new_person = forms.AttendeeForm(obj = None).add_hosts(hosts),
+        emails = [ e for (e,) in db.Person.select(db.Person.email).tuples() ],
+        host_choices = choices,
+        new_person = new_person,
+        page = page,
     )
 
 @frontend.route('/org/attendees/attendees.csv')
 @auth.login_required
+@read_only
 def admin_attendees_csv():
+    def rows():
+        yield [
+            'Name', 'Username', 'E-mail', 'Arrival', 'Departure',
+            'Shirt size', 'Host', 'Dietary requirements',
+            'Purchases', 'Paid', 'Balance',
+        ]
+
+        for (p, balance, purchases) in db.Person.statements():
+            shirts = [
+                b.item.name[len('Shirt '):].strip('()') for b in purchases
+                if b.item.name.startswith('Shirt ')
+            ]
+
+            yield [
+                p.name, p.username, p.email, p.arrival, p.departure,
+                p.shirt_size or ' '.join(shirts), p.host_name,
+                p.dietary_needs,
+                '%.2f' % p.total_purchases().value(),
+                '%.2f' % p.paid().value(),
+                '%.2f' % balance.value(),
+            ]
+
     return flask.Response(
-            flask.render_template('admin/attendees.csv',
-                attendees = db.Person.select()),
+            flask.stream_with_context(csv_lines(rows())),
             mimetype = 'text/csv',
     )
 
+def csv_lines(rows):
+    """ Format rows of values as CSV, one line at a time. """
+    class Line(object):
+        def write(self, data):
+            self.data = data
+
+    line = Line()
+    writer = csv.writer(line)
+
+    for row in rows:
+        writer.writerow([
+            '' if v is None else unicode(v).encode('utf-8') for v in row
+        ])
+        yield line.data
+
 @frontend.route('/org/attendees/email')
 @auth.login_required
+@read_only
 def admin_attendees_email():
     return flask.Response(
             flask.render_template('admin/attendee-emails.txt',
@@ -322,13 +578,20 @@ def admin_attendees_mail_all():
         if flask.request.method == 'POST':
             if form.validate_on_submit():
                 subject = '[%s] %s' % (config.SITE_TITLE, form.subject.data)
-                mail.send([ p.email for p in attendees ],
+                link = lambda p: flask.url_for(
+                        'nerf-herder frontend.attendee', id = p.id,
+                        auth = p.auth(), _external = True)
+
+                import mail
+                count = mail.enqueue_many(mail.personalise(
+                    db.Person.statements(),
                     subject = subject,
                     body = form.body.data,
-                )
+                    link = link,
+                ))
 
-                flask.flash(u"Sent '%s' to %d attendees" % (
-                    subject, attendees.count()),
+                flask.flash(u"Queued '%s' for %d attendees" % (
+                    subject, count),
                     'info')
 
             for field, errors in form.errors.items():
@@ -349,6 +612,64 @@ def admin_attendees_mail_all():
         site_title = config.SITE_TITLE,
     )
 
+@frontend.route('/org/mail/')
+@auth.login_required
+def admin_mail():
+    now = datetime.datetime.now()
+
+    return flask.render_template('admin/mail-queue.html',
+        messages = db.QueuedMail.select().limit(200),
+        counts = db.QueuedMail.status_counts(),
+        sent_last_hour = db.QueuedMail.sent_since(
+            now - datetime.timedelta(hours = 1)),
+    )
+
+@frontend.route('/org/db-pool')
+@auth.login_required
+def admin_db_pool():
+    # Statistics are per-process: each uWSGI worker keeps its own pool.
+    return flask.jsonify(database.stats())
+
+@frontend.route('/org/metrics')
+@auth.login_required
+def admin_metrics():
+    # Like the pool statistics, these metrics are per-process.
+    pools = [ ('primary', database) ] + [
+        ('replica%d' % i, r) for (i, r) in enumerate(db.replicas)
+    ]
+    pool_stats = [ (name, pool.stats()) for (name, pool) in pools ]
+
+    extra = [
+        ('nerfherd_db_pool_connections', 'gauge',
+         'Database connections in the pool', [
+            ({ 'database': name, 'state': state }, stats[state])
+            for (name, stats) in pool_stats
+            for state in ('in_use', 'idle')
+        ]),
+        ('nerfherd_db_pool_checkouts_total', 'counter',
+         'Connections checked out of the pool', [
+            ({ 'database': name }, stats['checkouts'])
+            for (name, stats) in pool_stats
+        ]),
+        ('nerfherd_db_pool_wait_seconds_total', 'counter',
+         'Time spent waiting for pooled connections', [
+            ({ 'database': name }, stats['wait_total'])
+            for (name, stats) in pool_stats
+        ]),
+        ('nerfherd_db_pool_timeouts_total', 'counter',
+         'Timeouts waiting for pooled connections', [
+            ({ 'database': name }, stats['timeouts'])
+            for (name, stats) in pool_stats
+        ]),
+        ('nerfherd_mail_queue', 'gauge', 'Queued messages by status', [
+            ({ 'status': status }, count)
+            for (status, count) in db.QueuedMail.status_counts().items()
+        ]),
+    ]
+
+    return flask.Response(metrics.render(extra),
+                          mimetype = 'text/plain; version=0.0.4')
+
 @frontend.route('/org/attendees/update', methods = [ 'POST' ])
 @auth.login_required
 def admin_attendee_update():
@@ -406,7 +727,7 @@ def admin_poi():
 
         else:
             try:
-                p = db.POI.create(
+                p = db.POI(
                     title = new_poi.title.data,
                     description = new_poi.description.data,
                     latitude = new_poi.latitude.data,
@@ -414,27 +735,79 @@ def admin_poi():
                     icon = new_poi.icon.data,
                 )
 
-                if new_poi.height:
+                if new_poi.height.data:
                     p.height = new_poi.height.data
 
-                if new_poi.width:
+                if new_poi.width.data:
                     p.width = new_poi.width.data
 
+                p.save()
+                geo.index.saved(p)
+
             except db.peewee.IntegrityError, e:
                 flask.flash(u"Error: %s" % e, 'error')
 
+            cache.invalidate()
             new_poi = forms.POIForm(None)
 
+    page = paginate(db.POI.select(),
+        sort_keys = { 'id': db.POI.id, 'title': db.POI.title },
+        default = 'title',
+        search = (db.POI.title, db.POI.description),
+    )
+
     return flask.render_template('admin/poi.html',
-        forms = [
-            forms.POIUpdateForm(None, obj = p)
-            for p in db.POI.select()
-        ],
-        poi = db.POI.select(),
+        forms = [ forms.POIUpdateForm(None, obj = p) for p in page ],
+        page = page,
         mapbox_access_token = config.MAPBOX_TOKEN,
         new_poi = new_poi,
+        poi_import = forms.POIImportForm(None),
     )
 
+@frontend.route('/org/poi/import', methods = [ 'POST' ])
+@auth.login_required
+def admin_poi_import():
+    form = forms.POIImportForm()
+
+    if not form.validate_on_submit():
+        for field, errors in form.errors.items():
+            for error in errors:
+                flask.flash(u"Problem with '%s': %s" % (
+                    getattr(form, field).label.text, error),
+                    'error')
+
+    else:
+        upload = form.file.data
+
+        import imports
+        try:
+            result = imports.import_poi(
+                imports.records(upload.stream, upload.filename),
+                icon = form.icon.data,
+            )
+
+        except ValueError, e:
+            flask.flash(u"Unable to read '%s': %s" % (upload.filename, e),
+                        'error')
+
+        else:
+            # Flashed messages are kept in the session cookie; don't overflow it.
+            for (where, error) in result.errors[:10]:
+                flask.flash(u"%s: %s" % (where, error), 'error')
+
+            if len(result.errors) > 10:
+                flask.flash(u'... and %d more problems' % (
+                    len(result.errors) - 10), 'error')
+
+            flask.flash(u'Created %d POIs, updated %d, rejected %d' % (
+                result.created, result.updated, len(result.errors)))
+
+            geo.index.clear()
+            cache.invalidate()
+
+    return flask.redirect(flask.url_for('nerf-herder frontend.admin_poi'))
+
+
 @frontend.route('/org/poi/update', methods = [ 'POST' ])
 @auth.login_required
 def admin_poi_update():
@@ -463,6 +836,8 @@ def admin_poi_update():
                 p.width = form.width.data
 
             p.save()
+            geo.index.saved(p)
+            cache.invalidate()
 
         except Exception, e:
             flask.flash(u"Error: %s" % e, 'error')
@@ -476,6 +851,8 @@ def admin_poi_delete():
     try:
         form = forms.POIUpdateForm()
         db.POI.get(id = form.id.data).delete_instance()
+        geo.index.deleted(form.id.data)
+        cache.invalidate()
 
     except Exception, e:
         flask.flash(str(e), 'error')
@@ -509,12 +886,20 @@ def admin_products():
 
     new = forms.ProductForm(None)
 
+    page = paginate(db.Product.with_statistics(),
+        sort_keys = {
+            'id': db.Product.id,
+            'name': db.Product.name,
+            'cost': db.Product.cost,
+        },
+        default = 'name',
+        search = (db.Product.name, db.Product.description),
+    )
+
     return flask.render_template('admin/products.html',
-        products = [
-            (p, forms.ProductUpdateForm(None, obj = p))
-            for p in db.Product.select()
-        ],
+        products = [ (p, forms.ProductUpdateForm(None, obj = p)) for p in page ],
         new = new,
+        page = page,
     )
 
 @frontend.route('/org/products/update', methods = [ 'POST' ])
@@ -558,6 +943,7 @@ def admin_product_delete():
 def admin_purchases():
     (person, product) = (None, None)
     new = None
+    page = None
     purchases = list()
     total = db.Money(0)
 
@@ -590,16 +976,38 @@ def admin_purchases():
         )
 
         if person:
-            purchases = person.purchases
+            purchases = db.Purchase.with_details() \
+                                   .where(db.Purchase.buyer == person)
+            total = person.total_purchases()
 
         elif product:
-            purchases = product.purchases
+            purchases = db.Purchase.with_details() \
+                                   .where(db.Purchase.item == product)
+            total = (
+                db.Product.with_statistics()
+                          .where(db.Product.id == product.id)
+                          .get()
+                          .all_purchases()
+            )
 
         else:
             new = None
 
+        if person or product:
+            page = paginate(purchases,
+                sort_keys = {
+                    'id': db.Purchase.id,
+                    'date': db.Purchase.date,
+                    'quantity': db.Purchase.quantity,
+                },
+                default = 'date',
+            )
+            purchases = list(page)
+
+        buyers = forms.people_choices(people)
+
         def update_form(p):
-            form = forms.PurchaseUpdateForm.create(people, products, p)
+            form = forms.PurchaseUpdateForm.create(buyers, products, p)
             form.redirect.data = redirect
             return (p, form)
 
@@ -610,12 +1018,13 @@ def admin_purchases():
         attendees = db.Person.select(),
         new = new,
         now = datetime.datetime.now(),
+        page = page,
         people = people,
         person = person,
         product = product,
         products = products,
         purchases = [ update_form(p) for p in purchases ],
-        total = sum(p.total() for p in purchases),
+        total = total,
     )
 
 
@@ -702,17 +1111,25 @@ def admin_payments():
                         'error')
 
     new = forms.PaymentForm(None).add_people(people)
+    choices = forms.people_choices(people)
+
+    page = paginate(db.Payment.with_payers(),
+        sort_keys = {
+            'id': db.Payment.id,
+            'date': db.Payment.date,
+            'value': db.Payment.value,
+        },
+        default = 'date',
+        search = (db.Payment.note,),
+    )
 
     return flask.render_template('admin/payments.html',
         payments = [
-            (
-                forms.PaymentUpdateForm(None, obj = p)
-                     .add_people(people)
-                     .set_payer(p.payer)
-            )
-            for p in db.Payment.select()
+            forms.PaymentUpdateForm.for_payment(p, choices) for p in page
         ],
         new = new,
+        page = page,
+        people_choices = choices,
     )
 
 @frontend.route('/org/payments/update', methods = [ 'POST' ])
@@ -761,17 +1178,23 @@ def admin_todo():
                         'error')
 
     new = forms.TodoForm(None).add_people(people)
+    choices = forms.people_choices(people, blank = True)
+
+    page = paginate(db.Todo.with_assignees(),
+        sort_keys = {
+            'id': db.Todo.id,
+            'deadline': db.Todo.deadline,
+            'description': db.Todo.description,
+        },
+        default = 'deadline',
+        search = (db.Todo.description,),
+    )
 
     return flask.render_template('admin/todos.html',
-        todos = [
-            (
-                forms.TodoUpdateForm(None, obj = t)
-                     .add_people(people)
-                     .set_assignee(t.assignee)
-            )
-            for t in db.Todo.select()
-        ],
+        todos = [ forms.TodoUpdateForm.for_todo(t, choices) for t in page ],
         new = new,
+        page = page,
+        people_choices = choices,
     )
 @frontend.route('/org/todo/update', methods = [ 'POST' ])
 @auth.login_required
@@ -824,6 +1247,7 @@ nav.nav.register_element('admin',
             nav.View('Purchases', '.admin_purchases'),
             nav.View('Payments', '.admin_payments'),
             nav.View('Todos', '.admin_todo'),
+            nav.View('Mail queue', '.admin_mail'),
         ),
         nav.View('Map', '.map'),
         nav.Subgroup(
@@ -848,6 +1272,39 @@ nav.nav.register_element('frontend_top',
 )
 
 
+def template_cache(directory = template_cache_dir):
+    """
+    Open the on-disk cache of compiled templates (or return None, with a
+    warning, if the cache directory can't be created).
+    """
+    if directory and not os.path.isdir(directory):
+        try: os.makedirs(directory)
+        except OSError, e:
+            warnings.warn('template cache unavailable: %s' % e)
+            return None
+
+    return jinja2.FileSystemBytecodeCache(directory)
+
+def compile_templates(app):
+    """
+    Compile every template that `app` can load (ours and those of Flask
+    extensions), storing the results in the app's bytecode cache.
+
+    Returns: ( [ template name ], [ ( template name, error ) ] )
+    """
+    (compiled, errors) = ([], [])
+
+    for name in app.jinja_env.list_templates():
+        try:
+            app.jinja_env.get_template(name)
+            compiled.append(name)
+
+        except jinja2.TemplateError, e:
+            errors.append((name, e))
+
+    return (compiled, errors)
+
+
 def create_app(dev_mode = True):
     # See http://flask.pocoo.org/docs/patterns/appfactories
     app = flask.Flask(__name__)
@@ -860,6 +1317,19 @@ def create_app(dev_mode = True):
     app.config['BOOTSTRAP_SERVE_LOCAL'] = True
     app.config['TEMPLATES_AUTO_RELOAD'] = dev_mode
 
+    # The Jinja environment has already been created by the extensions above,
+    # so the TEMPLATES_AUTO_RELOAD setting needs to be applied to it directly:
+    app.jinja_env.auto_reload = dev_mode
+    app.jinja_env.template_class = metrics.TimedTemplate
+
+    if not dev_mode:
+        app.jinja_env.bytecode_cache = template_cache()
+
+    if dev_mode:
+        app.before_request(_record_queries)
+        app.after_request(_check_queries)
+        app.teardown_request(_stop_recording)
+
     import crypto
     app.config['PREREGISTRATION_CODE'] = crypto.hmac('preregistration')
 
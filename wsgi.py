@@ -22,9 +22,20 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import config
+import db
 import webapp
 
-application = webapp.create_app()
+application = webapp.create_app(dev_mode = False)
+
+# uWSGI loads this file once in its master process and then forks the
+# workers (unless `lazy-apps` is set), so each worker must open its own
+# database connections rather than sharing any that the master opened.
+try:
+    import uwsgidecorators
+    uwsgidecorators.postfork(db.after_fork)
+
+except ImportError:
+    pass
 
 if config.REGISTRATION_IS_OPEN:
     print(" * Registration is OPEN")